@@ -0,0 +1,36 @@
+import gc
+import time
+import tracemalloc
+from main import Symb, Funcs, VFunc, Surface, schedule, diff_cache
+
+u = Symb("u")
+v = Symb("v")
+
+# normal field of a wavy torus and all its partial derivatives up to
+# fifth order, some 30 to 45 thousand distinct nodes depending on how far
+# the simplifier gets
+R = 2 + Funcs.cos(v) * (1 + 0.2 * Funcs.sin(5 * u) * Funcs.cos(3 * v))
+r = VFunc(R * Funcs.cos(u), R * Funcs.sin(u), Funcs.sin(v) * Funcs.ln(3 + Funcs.cos(u * v)))
+
+gc.collect()
+tracemalloc.start()
+start = time.perf_counter()
+
+surface = Surface(r)
+exprs = list(surface.normal_vector.funcs) + list(surface.normal_vector_norm.funcs)
+layer = exprs
+for order in range(5):
+    layer = [e.diff(var) for e in layer for var in (u, v)]
+    exprs = exprs + layer
+diff_cache.clear()
+gc.collect()
+
+elapsed = time.perf_counter() - start
+current, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+nodes = len(schedule(exprs)[0])
+print(f"distinct nodes: {nodes}")
+print(f"build time: {elapsed:.2f}s")
+print(f"retained: {current / 2 ** 20:.1f} MiB, {current / nodes:.0f} bytes per node")
+print(f"peak: {peak / 2 ** 20:.1f} MiB")
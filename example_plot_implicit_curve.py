@@ -0,0 +1,10 @@
+from main import Symb, Funcs, ImplicitCurve2D
+
+x = Symb("x")
+y = Symb("y")
+
+# lemniscate of Bernoulli with a ripple
+F = (x ** 2 + y ** 2) ** 2 - 2 * (x ** 2 - y ** 2) + Funcs.sin(10 * x) * 0.05
+
+curve = ImplicitCurve2D(F, level=0)
+curve.show(x_range=(-2, 2), y_range=(-1, 1), n=1024)
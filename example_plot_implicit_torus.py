@@ -0,0 +1,14 @@
+from main import Symb, ImplicitSurface
+
+x = Symb("x")
+y = Symb("y")
+z = Symb("z")
+
+R = 2
+r = 0.75
+
+# (x^2 + y^2 + z^2 + R^2 - r^2)^2 - 4R^2(x^2 + y^2) = 0
+F = (x ** 2 + y ** 2 + z ** 2 + (R ** 2 - r ** 2)) ** 2 - 4 * R ** 2 * (x ** 2 + y ** 2)
+
+surface = ImplicitSurface(F, level=0)
+surface.show(x_range=(-3, 3), y_range=(-3, 3), z_range=(-1, 1), n=64)
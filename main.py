@@ -1,48 +1,117 @@
+import copy
+import hashlib
+import marshal
+import operator
+import os
+import sys
+import threading
+from collections import OrderedDict
+from enum import IntEnum
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import matplotlib.pyplot as plt
 from skimage import measure
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
+# operation of a node, also the opcode of Program instructions
+class Op(IntEnum):
+    SIN = 0
+    COS = 1
+    SQRT = 2
+    LN = 3
+    NEG = 4
+    ADD = 5
+    SUB = 6
+    MUL = 7
+    DIV = 8
+    POW = 9
+
+# symbol and canonical scalar function of each opcode, so that interned
+# nodes do not depend on which function happened to build them first
+OP_SYMBS = ("sin", "cos", "sqrt", "ln", "-", "+", "-", "*", "/", "^")
+OP_FUNCS = (np.sin, np.cos, np.sqrt, np.log, operator.neg,
+            operator.add, operator.sub, operator.mul, operator.truediv, operator.pow)
+UNARY_OPCODES = {OP_SYMBS[op]: op for op in Op if op <= Op.NEG}
+BINARY_OPCODES = {OP_SYMBS[op]: op for op in Op if op >= Op.ADD}
+
+# variable sets shared by every node without symbols
+NO_VARS = frozenset()
+
+# structural key -> node, entries disappear with the last reference to the node
+interned = weakref.WeakValueDictionary()
+
+def intern_node(cls, key, **attrs):
+    # structurally equal nodes are built once and shared, turning trees into a DAG
+    node = interned.get(key)
+    if node is None:
+        node = object.__new__(cls)
+        for name, value in attrs.items():
+            object.__setattr__(node, name, value)
+        object.__setattr__(node, "key", key)
+        object.__setattr__(node, "hashval", hash(key))
+        interned[key] = node
+    return node
+
 class Symb:
-    def __init__(self, symb):
-        self.symb = symb
-        self.arity = 1
-        self.vars = set(symb) # convenience for plotting
+    __slots__ = ("key", "hashval", "symb", "vars", "__weakref__")
+    arity = 1
+    size = 1
+
+    def __new__(cls, symb):
+        return intern_node(
+            cls, ("symb", symb),
+            symb=symb,
+            vars=frozenset([symb]) # shared by every node whose only variable is symb
+        )
 
     def __eq__(self, other):
-        return self.symb == other.symb
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return self.hashval
+
+    def __setattr__(self, name, value):
+        raise AttributeError("expression nodes are immutable")
+
+    def __reduce__(self):
+        return (Symb, (self.symb,))
 
     def __add__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __radd__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __rmul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __mul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __neg__(self):
-        return resolve_ufunc(lambda x:-x, self, "-")
+        return resolve_ufunc(operator.neg, self, "-")
     
     def __truediv__(self, other):
-        return resolve_bfunc(lambda x,y:x/y, self, other, "/")
+        return resolve_bfunc(operator.truediv, self, other, "/")
     
     def __pow__(self, other):
-        return resolve_bfunc(lambda x,y:x**y, self, other, "^")
+        return resolve_bfunc(operator.pow, self, other, "^")
     
     def __sub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, self, other, "-")
     
     def __rsub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, other, self, "-")
     
     def __str__(self):
         return self.symb
     
     def diff(self, var):
+        return diff_cache.lookup(self, var, self.derivative)
+
+    def derivative(self, var):
         if var.symb == self.symb:
             return CFunc(1)
         return CFunc(0)
@@ -56,11 +125,40 @@ class Symb:
         # p is scalar
         return p
 
+    def compile(self):
+        return compile_node(self)
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        kernel = self.compile()
+        return evaluate_points(lambda vars: (kernel(vars),), self.vars, P, order, 1, chunk)[:, 0]
+
+    def to_program(self):
+        return Program([self])
+
+    def simplify(self):
+        return simplify(self)
+
 class CFunc:
-    def __init__(self, num):
-        self.num = num
-        self.vars = set() # convenient for variable collection
-        self.arity = 0
+    __slots__ = ("key", "hashval", "num", "__weakref__")
+    vars = NO_VARS
+    arity = 0
+    size = 1
+
+    def __new__(cls, num):
+        # the type is part of the key so that 2 and 2.0 stay distinct
+        return intern_node(cls, ("const", type(num), num), num=num)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return self.hashval
+
+    def __setattr__(self, name, value):
+        raise AttributeError("expression nodes are immutable")
+
+    def __reduce__(self):
+        return (CFunc, (self.num,))
 
     def __str__(self):
         return str(self.num)
@@ -76,33 +174,46 @@ class CFunc:
     
     def eval(self, vars):
         return self.num
+
+    def compile(self):
+        return compile_node(self)
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        kernel = self.compile()
+        return evaluate_points(lambda vars: (kernel(vars),), self.vars, P, order, 1, chunk)[:, 0]
+
+    def to_program(self):
+        return Program([self])
+
+    def simplify(self):
+        return simplify(self)
     
     def __add__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __radd__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __sub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, self, other, "-")
     
     def __rsub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, other, self, "-")
     
     def __rmul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __mul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __neg__(self):
-        return resolve_ufunc(lambda x:-x, self, "-")
+        return resolve_ufunc(operator.neg, self, "-")
     
     def __truediv__(self, other):
-        return resolve_bfunc(lambda x,y:x/y, self, other, "/")
+        return resolve_bfunc(operator.truediv, self, other, "/")
     
     def __pow__(self, other):
-        return resolve_bfunc(lambda x,y:x**y, self, other, "^")
+        return resolve_bfunc(operator.pow, self, other, "^")
 
 class Funcs:
 
@@ -123,47 +234,95 @@ class Funcs:
         return resolve_ufunc(np.log, obj, "ln")
 
 class UFunc:
-    def __init__(self, func, body, funcsymb):
-        self.func = func
-        self.body = body
-        self.funcsymb = funcsymb
-        self.vars = get_vars(self) # set of symbols
-        self.arity = len(self.vars)
+    __slots__ = ("key", "hashval", "op", "body", "vars", "size", "__weakref__")
+
+    def __new__(cls, func, body, funcsymb):
+        # func is only kept for compatibility, the opcode decides the function
+        assert funcsymb in UNARY_OPCODES, AssertionError(f"unknown function {funcsymb}")
+        if isinstance(body, (int, float)):
+            body = CFunc(body)
+        op = UNARY_OPCODES[funcsymb]
+        return intern_node(
+            cls, ("ufunc", op, body),
+            op=op,
+            body=body,
+            vars=body.vars, # set of symbols
+            size=1 + body.size # node count of the expanded tree
+        )
+
+    @property
+    def func(self):
+        return OP_FUNCS[self.op]
+
+    @property
+    def funcsymb(self):
+        return OP_SYMBS[self.op]
+
+    @property
+    def arity(self):
+        return len(self.vars)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return self.hashval
+
+    def __setattr__(self, name, value):
+        raise AttributeError("expression nodes are immutable")
+
+    def __reduce__(self):
+        return (UFunc, (self.func, self.body, self.funcsymb))
 
     def __add__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __radd__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __sub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, self, other, "-")
     
     def __rsub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, other, self, "-")
     
     def __rmul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __mul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __neg__(self):
-        return resolve_ufunc(lambda x:-x, self, "-")
+        return resolve_ufunc(operator.neg, self, "-")
     
     def __truediv__(self, other):
-        return resolve_bfunc(lambda x,y:x/y, self, other, "/")
+        return resolve_bfunc(operator.truediv, self, other, "/")
     
     def __pow__(self, other):
-        return resolve_bfunc(lambda x,y:x**y, self, other, "^")
+        return resolve_bfunc(operator.pow, self, other, "^")
     
     def eval(self, vars):
         return self.func(self.body.eval(vars))
+
+    def compile(self):
+        return compile_node(self)
+
+    def to_program(self):
+        return Program([self])
+
+    def simplify(self):
+        return simplify(self)
     
     def eval_point(self, p):
         # p is a tuple of size amount of vars
         assert len(p) == self.arity, AssertionError()
-        return self.eval({var : pcoord for var, pcoord in zip(list(self.vars), p)})
+        return self.eval_points([p])[0]
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        # P is (N, k), its columns are the variables in order, sorted by
+        # default; returns the N values
+        kernel = self.compile()
+        return evaluate_points(lambda vars: (kernel(vars),), self.vars, P, order, 1, chunk)[:, 0]
 
     def __str__(self):
         if isinstance(self.body, (UFunc, BFunc)):
@@ -171,17 +330,20 @@ class UFunc:
         return f"{self.funcsymb}({self.body})"
     
     def diff(self, var):
+        return diff_cache.lookup(self, var, self.derivative)
+
+    def derivative(self, var):
 
         if self.funcsymb == "sin":
             return resolve_bfunc(
-                lambda x,y:x*y,
+                operator.mul,
                 UFunc(np.cos, self.body, "cos"),
                 self.body.diff(var),
                 "*"
             )
         if self.funcsymb == "cos":
             return resolve_bfunc(
-                lambda x,y:x*y,
+                operator.mul,
                 -UFunc(np.sin, self.body, "sin"),
                 self.body.diff(var),
                 "*"
@@ -189,894 +351,217 @@ class UFunc:
         
         if self.funcsymb == "sqrt":
             return resolve_bfunc(
-                lambda x,y:x/y,
+                operator.truediv,
                 self.body.diff(var),
-                BFunc(lambda x,y:x*y, 2, Funcs.sqrt(self.body), "*"),
+                BFunc(operator.mul, 2, Funcs.sqrt(self.body), "*"),
                 "/"
             )
 
+        if self.funcsymb == "ln":
+            return resolve_bfunc(
+                operator.truediv,
+                self.body.diff(var),
+                self.body,
+                "/"
+            )
+
+        if self.funcsymb == "-":
+            return -self.body.diff(var)
+
+def to_node(obj):
+    # plain numbers become constants, nodes are reused as they are
+    if isinstance(obj, (int, float)):
+        return CFunc(obj)
+    return obj
+
 def resolve_ufunc(func, body, funcsymb):
 
-    if isinstance(body, int):
-        return CFunc(func(body))
+    # body is already resolved, only the new node is simplified
+    body = to_node(body)
+
     if isinstance(body, CFunc):
         return CFunc(func(body.num))
-    if isinstance(body, Symb):
-        return UFunc(func, body, funcsymb)
-    if isinstance(body, UFunc):
-        body_res = resolve_ufunc(body.func, body.body, body.funcsymb)
-        return UFunc(func, body_res, funcsymb)
-    # body is BFunc
-    body_res = resolve_bfunc(body.func, body.left, body.right, body.funcsymb)
-    return UFunc(func, body_res, funcsymb)
-        
+    if funcsymb == "-" and isinstance(body, UFunc) and body.funcsymb == "-":
+        return body.body
+    if funcsymb == "-" and isinstance(body, (Symb, Poly)):
+        return make_poly({mono: -c for mono, c in poly_terms(body).items()})
+    return UFunc(func, body, funcsymb)
+
 def resolve_bfunc(func, left, right, funcsymb):
 
+    # left and right are already resolved, only the new node is simplified
+    left = to_node(left)
+    right = to_node(right)
+
+    if isinstance(left, CFunc) and isinstance(right, CFunc):
+        if funcsymb == "/" and right.isnull():
+            raise AssertionError()
+        return CFunc(func(left.num, right.num))
+
+    if isinstance(left, (Symb, CFunc, Poly)) and isinstance(right, (Symb, CFunc, Poly)):
+        res = resolve_poly(left, right, funcsymb)
+        if res is not None:
+            return res
+
+    left_zero = isinstance(left, CFunc) and left.isnull()
+    right_zero = isinstance(right, CFunc) and right.isnull()
+    left_one = isinstance(left, CFunc) and left.isone()
+    right_one = isinstance(right, CFunc) and right.isone()
+
     if funcsymb == "+":
-        
-        if (
-            isinstance(left, int) and left == 0
-            or
-            isinstance(left, CFunc) and left.isnull()
-        ):
-            # only returning right
-            if isinstance(right, int):
-                return CFunc(right)
-            if isinstance(right, (Symb, CFunc)):
-                return right
-            if isinstance(right, UFunc):
-                return resolve_ufunc(right.func, right.body, right.funcsymb)
-            # right is BFunc
-            return resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        
-        # left non zero
-        if (
-            isinstance(right, int) and right == 0
-            or
-            isinstance(right, CFunc) and right.isnull()
-        ):
-            # right is zero
-            if isinstance(left, int):
-                return CFunc(left)
-            if isinstance(left, (Symb, CFunc)):
-                return left
-            if isinstance(left, UFunc):
-                return resolve_ufunc(left.func, left.body, left.funcsymb)
-            # right is BFunc
-            return resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-        
-        # left and right non zero
-        if isinstance(left, int):
-
-            if isinstance(right, int):
-                return CFunc(left + right)
-            if isinstance(right, CFunc):
-                return CFunc(left + right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, CFunc(left), right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, CFunc(left), right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, CFunc(left), right_res, funcsymb)
-        
-        if isinstance(left, CFunc):
-
-            if isinstance(right, int):
-                return CFunc(left.num + right)
-            if isinstance(right, CFunc):
-                return CFunc(left.num + right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, Symb):
-
-            if isinstance(right, int):
-                return BFunc(func, left, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, Symb):
-                if left.symb == right.symb:
-                    return BFunc(lambda x,y:x*y, CFunc(2), right, "*")
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, UFunc):
-
-            left_res = resolve_ufunc(left.func, left.body, left.funcsymb)
-
-            if isinstance(right, int):
-                return BFunc(func, left_res, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, Symb):
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left_res, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        
-        # left is BFunc
-
-        left_res = resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-
-        if isinstance(right, int):
-            return BFunc(func, left_res, CFunc(right), funcsymb)
-        if isinstance(right, CFunc):
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, Symb):
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, UFunc):
-            right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        # right is BFunc
-        right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        return BFunc(func, left_res, right_res, funcsymb)
-    
+        if left_zero:
+            return right
+        if right_zero:
+            return left
+        if left is right:
+            return BFunc(operator.mul, CFunc(2), right, "*")
+
     if funcsymb == "-":
+        if left_zero:
+            return resolve_ufunc(operator.neg, right, "-")
+        if right_zero:
+            return left
+        if left is right:
+            return CFunc(0)
 
-        if (
-            isinstance(left, int) and left == 0
-            or
-            isinstance(left, CFunc) and left.isnull()
-        ):
-            # only returning right
-            if isinstance(right, int):
-                return CFunc(-right)
-            if isinstance(right, (Symb, CFunc)):
-                return -right
-            if isinstance(right, UFunc):
-                return -resolve_ufunc(right.func, right.body, right.funcsymb)
-            # right is BFunc
-            return -resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        
-        # left non zero
-        if (
-            isinstance(right, int) and right == 0
-            or
-            isinstance(right, CFunc) and right.isnull()
-        ):
-            # right is zero
-            if isinstance(left, int):
-                return CFunc(left)
-            if isinstance(left, (Symb, CFunc)):
-                return left
-            if isinstance(left, UFunc):
-                return resolve_ufunc(left.func, left.body, left.funcsymb)
-            # right is BFunc
-            return resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-        
-        # left and right non zero
-        if isinstance(left, int):
-
-            if isinstance(right, int):
-                return CFunc(left - right)
-            if isinstance(right, CFunc):
-                return CFunc(left - right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, CFunc(left), right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, CFunc(left), right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, CFunc(left), right_res, funcsymb)
-        
-        if isinstance(left, CFunc):
-
-            if isinstance(right, int):
-                return CFunc(left.num - right)
-            if isinstance(right, CFunc):
-                return CFunc(left.num - right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, Symb):
-
-            if isinstance(right, int):
-                return BFunc(func, left, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, Symb):
-                if left.symb == right.symb:
-                    return CFunc(0)
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, UFunc):
-
-            left_res = resolve_ufunc(left.func, left.body, left.funcsymb)
-
-            if isinstance(right, int):
-                return BFunc(func, left_res, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, Symb):
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                return BFunc(func, left_res, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        
-        # left is BFunc
-
-        left_res = resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-
-        if isinstance(right, int):
-            return BFunc(func, left_res, CFunc(right), funcsymb)
-        if isinstance(right, CFunc):
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, Symb):
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, UFunc):
-            right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        # right is BFunc
-        right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        return BFunc(func, left_res, right_res, funcsymb)
-    
     if funcsymb == "*":
-        
-        if isinstance(left, int):
-
-            if left == 0:
-                return CFunc(0)
-
-            if isinstance(right, int):
-                return CFunc(left * right)
-            if isinstance(right, CFunc):
-                return CFunc(left * right.num)
-            if isinstance(right, Symb):
-                if left == 1:
-                    return right
-                return BFunc(func, CFunc(left), right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(0)
-                    return CFunc(right_res.num * left)
-                if left == 1:
-                    return right_res
-                return BFunc(func, CFunc(left), right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(0)
-                return CFunc(right_res.num * left)
-            if left == 1:
-                return right_res
-            return BFunc(func, CFunc(left), right_res, funcsymb)
-        
-        if isinstance(left, CFunc):
-
-            if left.isnull():
-                return CFunc(0)
-
-            if isinstance(right, int):
-                return CFunc(left.num * right)
-            if isinstance(right, CFunc):
-                return CFunc(left.num * right.num)
-            if isinstance(right, Symb):
-                if left.isone():
-                    return right
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(0)
-                    if left.isone():
-                        return right_res
-                    return BFunc(func, left, right_res, funcsymb)
-                if left.isone():
-                    return right_res
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(0)
-                return CFunc(right_res.num * left.num)
-            if left.isone():
-                return right_res
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, Symb):
-            
-            if isinstance(right, int):
-                if right == 1:
-                    return left
-                if right == 0:
-                    return CFunc(0)
-                return BFunc(func, left, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                if right.isone():
-                    return left
-                if right.isnull():
-                    return CFunc(0)
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(0)
-                    if right_res.isone():
-                        return left
-                    return BFunc(func, left, right_res, funcsymb)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(0)
-                if right_res.isone():
-                    return left
-                return BFunc(func, left, right_res, funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, UFunc):
-            left_res = resolve_ufunc(left.func, left.body, left.funcsymb)
-            if isinstance(left_res, CFunc) and left_res.isnull():
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 1:
-                    return left_res
-                if right == 0:
-                    return CFunc(0)
-                if isinstance(left_res, CFunc) and left_res.isone():
-                    return CFunc(right)
-                return BFunc(func, left_res, CFunc(right), funcsymb)
-            if isinstance(right, Symb):
-                if isinstance(left_res, CFunc) and left_res.isone():
-                    return right
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    return CFunc(0)
-                if right.isone():
-                    return left_res
-                if isinstance(left_res, CFunc) and left_res.isone():
-                    return right
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(left_res, CFunc) and left_res.isone():
-                    return right_res
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(0)
-                    if right_res.isone():
-                        return left_res
-                    return BFunc(func, left_res, right_res, funcsymb)
-                return BFunc(func, left_res, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(left_res, CFunc) and left_res.isone():
-                return right_res
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(0)
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)                
-        
-        # left is BFunc
-        left_res = resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-        if isinstance(left_res, CFunc) and left_res.isnull():
+        if left_zero or right_zero:
             return CFunc(0)
-        if isinstance(right, int):
-            if right == 1:
-                return left_res
-            if right == 0:
-                return CFunc(0)
-            if isinstance(left_res, CFunc) and left_res.isone():
-                return CFunc(right)
-            return BFunc(func, left_res, CFunc(right), funcsymb)
-        if isinstance(right, Symb):
-            if isinstance(left_res, CFunc) and left_res.isone():
-                return right
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, CFunc):
-            if right.isnull():
-                return CFunc(0)
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, UFunc):
-            right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-            if isinstance(left_res, CFunc) and left_res.isone():
-                return right_res
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(0)
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)    
-            return BFunc(func, left_res, right_res, funcsymb)    
-        # right is BFunc
-        right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        if isinstance(left_res, CFunc) and left_res.isone():
-            return right_res
-        if isinstance(right_res, CFunc):
-            if right_res.isnull():
-                return CFunc(0)
-            if right_res.isone():
-                return left_res
-            return BFunc(func, left_res, right_res, funcsymb)
-        return BFunc(func, left_res, right_res, funcsymb)
-    
-    if funcsymb == "/":
+        if left_one:
+            return right
+        if right_one:
+            return left
 
-        # left in (int, CF, Symb, UF, BF)
-        # right in (int, CF, Symb, UF, BF)
-
-        if isinstance(left, int):
-
-            if left == 0:
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    raise AssertionError()
-                return CFunc(left / right)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    raise AssertionError()
-                return CFunc(left / right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, CFunc(left), right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        raise AssertionError()
-                    if right_res.isone():
-                        return CFunc(left)
-                    return CFunc(left / right_res.num)
-                return BFunc(func, CFunc(left), right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_ufunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    raise AssertionError()
-                if right_res.isone():
-                    return CFunc(left)
-                return CFunc(left / right_res.num)
-            return BFunc(func, CFunc(left), right_res, funcsymb)
-        
-        if isinstance(left, CFunc):
-
-            if left.isnull():
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    raise AssertionError()
-                return CFunc(left.num / right)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    raise AssertionError()
-                return CFunc(left.num / right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        raise AssertionError()
-                    if right_res.isone():
-                        return left
-                    return CFunc(left.num / right_res.num)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_ufunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    raise AssertionError()
-                if right_res.isone():
-                    return left
-                return CFunc(left.num / right_res.num)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, Symb):
-
-            if isinstance(right, int):
-                if right == 0:
-                    raise AssertionError()
-                if right == 1:
-                    return left
-                return BFunc(func, left, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    raise AssertionError()
-                if right.isone():
-                    return left
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, Symb):
-                if right.symb == left.symb:
-                    return CFunc(1)
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        raise AssertionError()
-                    if right_res.isone():
-                        return left
-                    return BFunc(func, left, right_res, funcsymb)
-                if isinstance(right_res, Symb):
-                    if right_res.symb == left.symb:
-                        return CFunc(1)
-                    return BFunc(func, left, right_res, funcsymb)
-                # right_res is ufunc or bfunc
-                return BFunc(func, left, right_res, funcsymb)
-            # right is Bfunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    raise AssertionError()
-                if right_res.isone():
-                    return left
-                return BFunc(func, left, right_res, funcsymb)
-            if isinstance(right_res, Symb):
-                if right_res.symb == left.symb:
-                    return CFunc(1)
-                return BFunc(func, left, right_res, funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, UFunc):
-            left_res = resolve_ufunc(left.func, left.body, left.funcsymb)
-            if isinstance(left_res, CFunc) and left_res.isnull():
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    raise AssertionError()
-                if right == 1:
-                    return left_res
-                return BFunc(func, left_res, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    raise AssertionError()
-                if right.isone():
-                    return left_res
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, Symb):
-                if isinstance(left_res, Symb) and left_res.symb == right.symb:
-                    return CFunc(1)
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        raise AssertionError()
-                    if right_res.isone():
-                        return left_res
-                    return BFunc(func, left_res, right_res, funcsymb)
-                if isinstance(right_res, Symb):
-                    if isinstance(left_res, Symb) and left_res.symb == right_res.symb:
-                        return CFunc(1)
-                    return BFunc(func, left_res, right_res, funcsymb)
-                return BFunc(func, left_res, right_res, funcsymb)
-            # right is Bfunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    raise AssertionError()
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)
-            if isinstance(right_res, Symb):
-                if isinstance(left_res, Symb) and left_res.symb == right_res.symb:
-                    return CFunc(1)
-                return BFunc(func, left_res, right_res, funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        
-        # left is Bfunc
-        left_res = resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-        if isinstance(left_res, CFunc) and left_res.isnull():
+    if funcsymb == "/":
+        if right_zero:
+            raise AssertionError()
+        if left_zero:
             return CFunc(0)
-        if isinstance(right, int):
-            if right == 0:
-                raise AssertionError()
-            if right == 1:
-                return left_res
-            return BFunc(func, left_res, CFunc(right), funcsymb)
-        if isinstance(right, CFunc):
-            if right.isnull():
-                raise AssertionError()
-            if right.isone():
-                return left_res
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, Symb):
-            if isinstance(left_res, Symb) and left_res.symb == right.symb:
-                return CFunc(1)
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, UFunc):
-            right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    raise AssertionError()
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)
-            if isinstance(right_res, Symb):
-                if isinstance(left_res, Symb) and left_res.symb == right_res.symb:
-                    return CFunc(1)
-                return BFunc(func, left_res, right_res, funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        # right is Bfunc
-        right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        if isinstance(right_res, CFunc):
-            if right_res.isnull():
-                raise AssertionError()
-            if right_res.isone():
-                return left_res
-            return BFunc(func, left_res, right_res, funcsymb)
-        if isinstance(right_res, Symb):
-            if isinstance(left_res, Symb) and left_res.symb == right_res.symb:
-                return CFunc(1)
-            return BFunc(func, left_res, right_res, funcsymb)
-        return BFunc(func, left_res, right_res, funcsymb)
-    
+        if right_one:
+            return left
+        if left is right:
+            return CFunc(1)
 
     if funcsymb == "^":
-
-        if isinstance(left, int):
-
-            if left == 0:
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    return CFunc(1)
-                return CFunc(left ** right)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    return CFunc(1)
-                return CFunc(left ** right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, CFunc(left), right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(1)
-                    if right_res.isone():
-                        return CFunc(left)
-                    return CFunc(left ** right_res.num)
-                return BFunc(func, CFunc(left), right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_ufunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(1)
-                if right_res.isone():
-                    return CFunc(left)
-                return CFunc(left ** right_res.num)
-            return BFunc(func, CFunc(left), right_res, funcsymb)
-        
-        if isinstance(left, CFunc):
-
-            if left.isnull():
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    return CFunc(1)
-                return CFunc(left.num ** right)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    return CFunc(1)
-                return CFunc(left.num ** right.num)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(1)
-                    if right_res.isone():
-                        return left
-                    return CFunc(left.num ** right_res.num)
-                return BFunc(func, left, right_res, funcsymb)
-            # right is BFunc
-            right_res = resolve_ufunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(1)
-                if right_res.isone():
-                    return left
-                return CFunc(left.num ** right_res.num)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, Symb):
-
-            if isinstance(right, int):
-                if right == 0:
-                    return CFunc(1)
-                if right == 1:
-                    return left
-                return BFunc(func, left, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    return CFunc(1)
-                if right.isone():
-                    return left
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, Symb):
-                return BFunc(func, left, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(1)
-                    if right_res.isone():
-                        return left
-                    return BFunc(func, left, right_res, funcsymb)
-                # right_res is ufunc or bfunc or symb
-                return BFunc(func, left, right_res, funcsymb)
-            # right is Bfunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(1)
-                if right_res.isone():
-                    return left
-                return BFunc(func, left, right_res, funcsymb)
-            return BFunc(func, left, right_res, funcsymb)
-        
-        if isinstance(left, UFunc):
-            left_res = resolve_ufunc(left.func, left.body, left.funcsymb)
-            if isinstance(left_res, CFunc) and left_res.isnull():
-                return CFunc(0)
-            if isinstance(right, int):
-                if right == 0:
-                    return CFunc(1)
-                if right == 1:
-                    return left_res
-                return BFunc(func, left_res, CFunc(right), funcsymb)
-            if isinstance(right, CFunc):
-                if right.isnull():
-                    return CFunc(1)
-                if right.isone():
-                    return left_res
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, Symb):
-                return BFunc(func, left_res, right, funcsymb)
-            if isinstance(right, UFunc):
-                right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-                if isinstance(right_res, CFunc):
-                    if right_res.isnull():
-                        return CFunc(1)
-                    if right_res.isone():
-                        return left_res
-                    return BFunc(func, left_res, right_res, funcsymb)
-                return BFunc(func, left_res, right_res, funcsymb)
-            # right is Bfunc
-            right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(1)
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        
-        # left is Bfunc
-        left_res = resolve_bfunc(left.func, left.left, left.right, left.funcsymb)
-        if isinstance(left_res, CFunc) and left_res.isnull():
+        if right_zero:
+            return CFunc(1)
+        if right_one:
+            return left
+        if left_zero:
             return CFunc(0)
-        if isinstance(right, int):
-            if right == 0:
-                return CFunc(1)
-            if right == 1:
-                return left_res
-            return BFunc(func, left_res, CFunc(right), funcsymb)
-        if isinstance(right, CFunc):
-            if right.isnull():
-                return CFunc(1)
-            if right.isone():
-                return left_res
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, Symb):
-            return BFunc(func, left_res, right, funcsymb)
-        if isinstance(right, UFunc):
-            right_res = resolve_ufunc(right.func, right.body, right.funcsymb)
-            if isinstance(right_res, CFunc):
-                if right_res.isnull():
-                    return CFunc(1)
-                if right_res.isone():
-                    return left_res
-                return BFunc(func, left_res, right_res, funcsymb)
-            return BFunc(func, left_res, right_res, funcsymb)
-        
-        # right is Bfunc
-        right_res = resolve_bfunc(right.func, right.left, right.right, right.funcsymb)
-        if isinstance(right_res, CFunc):
-            if right_res.isnull():
-                return CFunc(1)
-            if right_res.isone():
-                return left_res
-            return BFunc(func, left_res, right_res, funcsymb)
-        return BFunc(func, left_res, right_res, funcsymb)
+        if left_one:
+            return CFunc(1)
+
+    return BFunc(func, left, right, funcsymb)
 
 def get_vars(exp):
-    if isinstance(exp, Symb):
-        return {exp.symb}
-    if isinstance(exp, UFunc):
-        return get_vars(exp.body)
-    if isinstance(exp, BFunc):
-        return get_vars(exp.left) | get_vars(exp.right)
-    return set()
+    # every node carries its variables, so this never walks the tree
+    if isinstance(exp, (Symb, CFunc, UFunc, BFunc, Poly)):
+        return exp.vars
+    return NO_VARS
+
+# variable set -> its one shared instance, there are only ever a few
+var_sets = {}
+
+def merge_vars(left, right):
+    # reuse a child's set whenever possible so that nodes share them
+    if right <= left:
+        return left
+    if left <= right:
+        return right
+    merged = left | right
+    return var_sets.setdefault(merged, merged)
 
 class BFunc:
-    def __init__(self, func, left, right, funcsymb):
-        self.func = func
-        self.left = left
-        self.right = right
-        self.funcsymb = funcsymb
-        self.vars = get_vars(self) # set of symbols
-        self.arity = len(self.vars)
+    __slots__ = ("key", "hashval", "op", "left", "right", "vars", "size", "__weakref__")
+
+    def __new__(cls, func, left, right, funcsymb):
+        # func is only kept for compatibility, the opcode decides the function
+        assert funcsymb in BINARY_OPCODES, AssertionError(f"unknown operator {funcsymb}")
+        if isinstance(left, (int, float)):
+            left = CFunc(left)
+        if isinstance(right, (int, float)):
+            right = CFunc(right)
+        op = BINARY_OPCODES[funcsymb]
+        return intern_node(
+            cls, ("bfunc", op, left, right),
+            op=op,
+            left=left,
+            right=right,
+            vars=merge_vars(left.vars, right.vars), # set of symbols
+            size=1 + left.size + right.size # node count of the expanded tree
+        )
+
+    @property
+    def func(self):
+        return OP_FUNCS[self.op]
+
+    @property
+    def funcsymb(self):
+        return OP_SYMBS[self.op]
+
+    @property
+    def arity(self):
+        return len(self.vars)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return self.hashval
+
+    def __setattr__(self, name, value):
+        raise AttributeError("expression nodes are immutable")
+
+    def __reduce__(self):
+        return (BFunc, (self.func, self.left, self.right, self.funcsymb))
 
     def __add__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __radd__(self, other):
-        return resolve_bfunc(lambda x,y:x+y, self, other, "+")
+        return resolve_bfunc(operator.add, self, other, "+")
     
     def __sub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, self, other, "-")
     
     def __rsub__(self, other):
-        return resolve_bfunc(lambda x,y:x-y, self, other, "-")
+        return resolve_bfunc(operator.sub, other, self, "-")
     
     def __rmul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __mul__(self, other):
-        return resolve_bfunc(lambda x,y:x*y, self, other, "*")
+        return resolve_bfunc(operator.mul, self, other, "*")
     
     def __neg__(self):
-        return resolve_ufunc(lambda x:-x, self, "-")
+        return resolve_ufunc(operator.neg, self, "-")
     
     def __truediv__(self, other):
-        return resolve_bfunc(lambda x,y:x/y, self, other, "/")
+        return resolve_bfunc(operator.truediv, self, other, "/")
     
     def __pow__(self, other):
-        return resolve_bfunc(lambda x,y:x**y, self, other, "^")
+        return resolve_bfunc(operator.pow, self, other, "^")
 
     def eval(self, vars):
         return self.func(self.left.eval(vars), self.right.eval(vars))
+
+    def compile(self):
+        return compile_node(self)
+
+    def to_program(self):
+        return Program([self])
+
+    def simplify(self):
+        return simplify(self)
     
     def eval_point(self, p):
         assert len(p) == self.arity, AssertionError()
-        return self.eval({var : pcoord for var, pcoord in zip(list(self.vars), p)})
+        return self.eval_points([p])[0]
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        kernel = self.compile()
+        return evaluate_points(lambda vars: (kernel(vars),), self.vars, P, order, 1, chunk)[:, 0]
         
     def __str__(self):
         if isinstance(self.left, (CFunc, Symb, UFunc)):
@@ -1086,6 +571,9 @@ class BFunc:
         return f"({self.left.__str__()}){self.funcsymb}({self.right.__str__()})"
     
     def diff(self, var):
+        return diff_cache.lookup(self, var, self.derivative)
+
+    def derivative(self, var):
 
         if self.funcsymb == "+":
             return resolve_bfunc(self.func, self.left.diff(var), self.right.diff(var), self.funcsymb)
@@ -1093,14 +581,14 @@ class BFunc:
             return resolve_bfunc(self.func, self.left.diff(var), self.right.diff(var), self.funcsymb)
         if self.funcsymb == "*":
             return resolve_bfunc(
-                lambda x,y:x+y,
+                operator.add,
                 self.left * self.right.diff(var),
                 self.right * self.left.diff(var),
                 "+"
             )
         if self.funcsymb == "/":
             return resolve_bfunc(
-                lambda x,y:x/y,
+                operator.truediv,
                 self.left.diff(var) * self.right - self.left * self.right.diff(var),
                 self.right ** 2,
                 "/"
@@ -1108,10 +596,10 @@ class BFunc:
         if self.funcsymb == "^":
             if isinstance(self.right, CFunc):
                 return resolve_bfunc(
-                    lambda x,y:x*y,
+                    operator.mul,
                     self.right,
                     resolve_bfunc(
-                        lambda x,y:x*y,
+                        operator.mul,
                         self.left ** CFunc(self.right.num - 1),
                         self.left.diff(var),
                         "*"
@@ -1120,17 +608,1367 @@ class BFunc:
                 )
             if isinstance(self.left, CFunc):
                 return resolve_bfunc(
-                    lambda x,y:x*y,
-                    self,
-                    Funcs.ln(self.left),
+                    operator.mul,
+                    self * Funcs.ln(self.left),
+                    self.right.diff(var),
                     "*"
                 )
+            # general case: (f^g)' = f^g * (g' * ln(f) + g * f' / f)
+            return resolve_bfunc(
+                operator.mul,
+                self,
+                self.right.diff(var) * Funcs.ln(self.left) + self.right * self.left.diff(var) / self.left,
+                "*"
+            )
+
+def poly_terms(exp):
+    # {monomial: coefficient} of a symbol, constant or polynomial, with
+    # monomials as name-sorted tuples of (symbol, exponent)
+    if isinstance(exp, CFunc):
+        return {(): exp.num} if exp.num != 0 else {}
+    if isinstance(exp, Symb):
+        return {((exp.symb, 1),): 1}
+    return dict(exp.terms)
+
+def make_poly(terms):
+    # smallest node for the terms: a constant, a bare symbol or a Poly
+    terms = {mono: number(c) for mono, c in terms.items() if c != 0}
+    if not terms:
+        return CFunc(0)
+    if list(terms) == [()]:
+        return CFunc(terms[()])
+    if len(terms) == 1:
+        (mono, c), = terms.items()
+        if c == 1 and len(mono) == 1 and mono[0][1] == 1:
+            return Symb(mono[0][0])
+    return Poly(tuple(sorted(terms.items(), key=lambda t: (-sum(e for _, e in t[0]), t[0]))))
+
+def poly_add(a, b, sign):
+    res = dict(a)
+    for mono, c in b.items():
+        res[mono] = res.get(mono, 0) + sign * c
+    return res
+
+def poly_mul(a, b):
+    # None when expanding would not pay off: only scalings and products
+    # of monomials are expanded, anything times a sum stays factored as a
+    # generic node over polynomials, so shared factors stay shared and
+    # evaluation is never more work than the original tree
+    if not (list(a) == [()] or list(b) == [()] or len(a) == len(b) == 1):
+        return None
+    res = {}
+    for ma, ca in a.items():
+        for mb, cb in b.items():
+            exps = dict(ma)
+            for name, e in mb:
+                exps[name] = exps.get(name, 0) + e
+            mono = tuple(sorted(exps.items()))
+            res[mono] = res.get(mono, 0) + ca * cb
+    return res
+
+def poly_pow(a, n):
+    # only monomials and constants are raised, powers of sums stay factored
+    if n == 0:
+        return {(): 1}
+    if len(a) != 1:
+        return a if n == 1 else None
+    (mono, c), = a.items()
+    return {tuple((name, e * n) for name, e in mono): c ** n}
+
+def resolve_poly(left, right, funcsymb):
+    # polynomial result of left funcsymb right, or None to build a BFunc
+    a = poly_terms(left)
+    if funcsymb in ("+", "-"):
+        return make_poly(poly_add(a, poly_terms(right), 1 if funcsymb == "+" else -1))
+    if funcsymb == "*":
+        res = poly_mul(a, poly_terms(right))
+    elif funcsymb == "/" and isinstance(right, CFunc) and right.num != 0:
+        res = {mono: c / right.num for mono, c in a.items()}
+    elif funcsymb == "^" and isinstance(right, CFunc) and float(right.num).is_integer() and right.num >= 0:
+        res = poly_pow(a, int(right.num))
+    else:
+        res = None
+    return make_poly(res) if res is not None else None
+
+# poly -> nested horner plan, and poly -> equivalent tree of plain nodes
+horner_plans = weakref.WeakKeyDictionary()
+horner_trees = weakref.WeakKeyDictionary()
+
+def horner_plan(terms, depth):
+    # terms maps dense exponent tuples to coefficients; the plan of the
+    # variable at depth is that variable's index and its exponents in
+    # decreasing order, each with the plan of its coefficient polynomial
+    if not terms or len(next(iter(terms))) == depth:
+        return sum(terms.values())
+    groups = {}
+    for exps, c in terms.items():
+        groups.setdefault(exps[depth], {})[exps] = c
+    return (depth, [(e, horner_plan(groups[e], depth + 1)) for e in sorted(groups, reverse=True)])
+
+def run_plan(plan, values, power, add, mul):
+    # value of a plan, with the arithmetic passed in so that the same
+    # walk evaluates arrays or builds an expression tree
+    if not isinstance(plan, tuple):
+        return plan
+    i, groups = plan
+    x = values[i]
+    res = None
+    prev = 0
+    for e, sub in groups:
+        s = run_plan(sub, values, power, add, mul)
+        res = s if res is None else add(mul(res, power(x, prev - e)), s)
+        prev = e
+    return mul(res, power(x, prev)) if prev else res
+
+def numeric_power(x, e):
+    return x if e == 1 else x ** e
+
+def evaluate_plan(plan, *values):
+    # horner scheme over whole arrays
+    return run_plan(plan, values, numeric_power, operator.add, numeric_mul)
+
+def numeric_mul(a, b):
+    # leading coefficients of one are common, skip the pass over the array
+    if isinstance(a, (int, float)) and a == 1:
+        return b
+    return a * b
+
+class Poly:
+
+    # sparse multivariate polynomial over symbols, a single node in place
+    # of the tree of sums and products it stands for. resolve_bfunc builds
+    # one for sums, differences and scalings of polynomials and for
+    # products and powers of monomials
+
+    __slots__ = ("key", "hashval", "terms", "names", "vars", "size", "__weakref__")
+
+    def __new__(cls, terms):
+        # terms is a tuple of (monomial, coefficient) pairs, see make_poly
+        names = tuple(sorted({name for mono, c in terms for name, e in mono}))
+        vars = NO_VARS
+        for name in names:
+            vars = merge_vars(vars, Symb(name).vars)
+        return intern_node(
+            cls, ("poly", terms),
+            terms=terms,
+            names=names,
+            vars=vars,
+            size=1 + sum(1 + 2 * len(mono) for mono, c in terms) # as a plain tree
+        )
+
+    @property
+    def func(self):
+        # bound to the plan, not the node, so kernels holding it do not
+        # keep the polynomial alive
+        plan = self.plan()
+        return lambda *values: evaluate_plan(plan, *values)
+
+    @property
+    def arity(self):
+        return len(self.vars)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return self.hashval
+
+    def __setattr__(self, name, value):
+        raise AttributeError("expression nodes are immutable")
+
+    def __reduce__(self):
+        return (Poly, (self.terms,))
+
+    def __add__(self, other):
+        return resolve_bfunc(operator.add, self, other, "+")
+    
+    def __radd__(self, other):
+        return resolve_bfunc(operator.add, self, other, "+")
+    
+    def __sub__(self, other):
+        return resolve_bfunc(operator.sub, self, other, "-")
+    
+    def __rsub__(self, other):
+        return resolve_bfunc(operator.sub, other, self, "-")
+    
+    def __rmul__(self, other):
+        return resolve_bfunc(operator.mul, self, other, "*")
+    
+    def __mul__(self, other):
+        return resolve_bfunc(operator.mul, self, other, "*")
+    
+    def __neg__(self):
+        return resolve_ufunc(operator.neg, self, "-")
+    
+    def __truediv__(self, other):
+        return resolve_bfunc(operator.truediv, self, other, "/")
+    
+    def __pow__(self, other):
+        return resolve_bfunc(operator.pow, self, other, "^")
+
+    def plan(self):
+        plan = horner_plans.get(self)
+        if plan is None:
+            pos = {name: i for i, name in enumerate(self.names)}
+            dense = {}
+            for mono, c in self.terms:
+                exps = [0] * len(self.names)
+                for name, e in mono:
+                    exps[pos[name]] = e
+                dense[tuple(exps)] = c
+            plan = horner_plans[self] = horner_plan(dense, 0)
+        return plan
+
+    def evaluate(self, *values):
+        # horner scheme over whole arrays, values follow self.names
+        return evaluate_plan(self.plan(), *values)
+
+    def eval(self, vars):
+        return self.evaluate(*[vars[name] for name in self.names])
+
+    def tree(self):
+        # the horner scheme as plain nodes, for backends without polynomials
+        tree = horner_trees.get(self)
+        if tree is None:
+            def power(x, e):
+                return x if e == 1 else BFunc(operator.pow, x, CFunc(e), "^")
+
+            def add(a, b):
+                return BFunc(operator.add, to_node(a), to_node(b), "+")
+
+            def mul(a, b):
+                if isinstance(a, (int, float)) and a == 1:
+                    return b
+                return BFunc(operator.mul, to_node(a), to_node(b), "*")
+
+            symbs = [Symb(name) for name in self.names]
+            tree = horner_trees[self] = run_plan(self.plan(), symbs, power, add, mul)
+        return tree
+
+    def compile(self):
+        return compile_node(self)
+
+    def to_program(self):
+        return Program([self])
+
+    def simplify(self):
+        return simplify(self)
+    
+    def eval_point(self, p):
+        assert len(p) == self.arity, AssertionError()
+        return self.eval_points([p])[0]
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        kernel = self.compile()
+        return evaluate_points(lambda vars: (kernel(vars),), self.vars, P, order, 1, chunk)[:, 0]
+
+    def __str__(self):
+        pieces = []
+        for mono, c in self.terms:
+            factors = [name if e == 1 else f"{name}^{e}" for name, e in mono]
+            if c == -1 and factors:
+                pieces.append("-" + "*".join(factors))
+            elif c != 1 or not factors:
+                pieces.append("*".join([str(c)] + factors))
+            else:
+                pieces.append("*".join(factors))
+        return "+".join(pieces).replace("+-", "-")
+
+    def diff(self, var):
+        return diff_cache.lookup(self, var, self.derivative)
+
+    def derivative(self, var):
+        terms = {}
+        for mono, c in self.terms:
+            exps = dict(mono)
+            e = exps.get(var.symb, 0)
+            if e == 0:
+                continue
+            if e == 1:
+                del exps[var.symb]
+            else:
+                exps[var.symb] = e - 1
+            mono = tuple(sorted(exps.items()))
+            terms[mono] = terms.get(mono, 0) + c * e
+        return make_poly(terms)
+
+# node -> the same expression without Poly nodes; nodes without any are
+# only marked, an entry mapping a node to itself would never be collected
+expanded = weakref.WeakKeyDictionary()
+poly_free = weakref.WeakSet()
+
+def expand_polys(exp):
+    # polynomials replaced by their horner trees, for the backends that
+    # lower to elementary operations
+    exp = to_node(exp)
+    if exp in poly_free:
+        return exp
+    res = expanded.get(exp)
+    if res is None:
+        if isinstance(exp, Poly):
+            res = exp.tree()
+        elif isinstance(exp, UFunc):
+            body = expand_polys(exp.body)
+            res = exp if body is exp.body else UFunc(exp.func, body, exp.funcsymb)
+        elif isinstance(exp, BFunc):
+            left, right = expand_polys(exp.left), expand_polys(exp.right)
+            res = exp if left is exp.left and right is exp.right else BFunc(exp.func, left, right, exp.funcsymb)
+        else:
+            res = exp
+        if res is exp:
+            poly_free.add(exp)
+        else:
+            expanded[exp] = res
+    return res
+
+# node -> its canonical form and the sum and product views of simplified
+# nodes: a constant plus {term: coefficient}, and a coefficient times
+# {base: exponent}, where terms are products without their coefficient.
+# an entry whose value holds its own key would keep the node alive for
+# good, so nodes already in canonical form are only marked, and forms
+# made of the node itself are rebuilt on demand
+simplified = weakref.WeakKeyDictionary()
+canonical = weakref.WeakSet()
+sum_forms = weakref.WeakKeyDictionary()
+product_forms = weakref.WeakKeyDictionary()
+
+def remember_form(forms, exp, form):
+    if exp not in form[1]:
+        forms.setdefault(exp, form)
+
+def number(x):
+    # integral values become ints so that 2 and 2.0 collect together
+    x = float(x)
+    if x.is_integer() and abs(x) < 2 ** 53:
+        return int(x)
+    return x
+
+def canonical_order(nodes):
+    return sorted(nodes, key=lambda n: (n.size, structural_digest(n)))
+
+def product_form(exp):
+    form = product_forms.get(exp)
+    if form is not None:
+        return form
+    if isinstance(exp, CFunc):
+        form = (number(exp.num), {})
+    elif isinstance(exp, Poly) and len(exp.terms) == 1:
+        (mono, c), = exp.terms
+        form = (c, {Symb(name): e for name, e in mono})
+    elif isinstance(exp, BFunc) and exp.op == Op.DIV and product_form(exp.right)[0] == 0:
+        form = (1, {exp: 1})
+    elif isinstance(exp, BFunc) and exp.op in (Op.MUL, Op.DIV):
+        form = merge_products(product_form(exp.left), product_form(exp.right), 1 if exp.op == Op.MUL else -1)
+    elif isinstance(exp, BFunc) and exp.op == Op.POW and isinstance(exp.right, CFunc):
+        form = power_form(exp.left, number(exp.right.num), exp)
+    elif isinstance(exp, UFunc) and exp.op == Op.SQRT:
+        form = power_form(exp.body, 0.5, exp)
+    elif isinstance(exp, UFunc) and exp.op == Op.NEG:
+        coef, bases = product_form(exp.body)
+        form = (-coef, bases)
+    else:
+        form = (1, {exp: 1})
+    remember_form(product_forms, exp, form)
+    return form
+
+def merge_products(left, right, sign):
+    coef = left[0] * right[0] if sign == 1 else left[0] / right[0]
+    bases = dict(left[1])
+    for base, e in right[1].items():
+        e = number(bases.get(base, 0) + sign * e)
+        if e == 0:
+            del bases[base]
+        else:
+            bases[base] = e
+    return number(coef), bases
+
+def power_form(base, n, exp):
+    # (c * prod b^e)^n is only split up where no sign can get lost
+    coef, bases = product_form(base)
+    if float(n).is_integer() and (coef != 0 or n > 0):
+        return number(coef ** n), {b: number(e * n) for b, e in bases.items()}
+    if coef == 1 and len(bases) == 1:
+        (b, e), = bases.items()
+        if e == 1 or not float(e).is_integer():
+            return 1, {b: number(e * n)}
+    return 1, {exp: 1}
+
+def sum_form(exp):
+    form = sum_forms.get(exp)
+    if form is not None:
+        return form
+    if isinstance(exp, CFunc):
+        form = (number(exp.num), {})
+    elif isinstance(exp, BFunc) and exp.op in (Op.ADD, Op.SUB):
+        form = merge_sums(sum_form(exp.left), sum_form(exp.right), 1 if exp.op == Op.ADD else -1)
+    elif isinstance(exp, Poly) and len(exp.terms) > 1:
+        terms = {}
+        const = 0
+        for mono, c in exp.terms:
+            if mono:
+                terms[product_node({Symb(name): e for name, e in mono})] = c
+            else:
+                const = c
+        form = (const, terms)
+    elif isinstance(exp, UFunc) and exp.op == Op.NEG:
+        const, terms = sum_form(exp.body)
+        form = (-const, {t: -c for t, c in terms.items()})
+    else:
+        coef, bases = product_form(exp)
+        form = (0, {product_node(bases): coef} if coef != 0 else {})
+    remember_form(sum_forms, exp, form)
+    return form
+
+def merge_sums(left, right, sign):
+    terms = dict(left[1])
+    for term, c in right[1].items():
+        add_term(terms, term, sign * c)
+    return number(left[0] + sign * right[0]), terms
+
+def product_node(bases):
+    # canonical product of powers, exponents below zero go to a denominator
+    num = CFunc(1)
+    den = CFunc(1)
+    for base in canonical_order(bases):
+        e = bases[base]
+        if abs(e) == 1:
+            power = base
+        elif abs(e) == 0.5:
+            power = resolve_ufunc(np.sqrt, base, "sqrt")
+        else:
+            power = resolve_bfunc(operator.pow, base, CFunc(abs(e)), "^")
+        if e > 0:
+            num = resolve_bfunc(operator.mul, num, power, "*")
+        else:
+            den = resolve_bfunc(operator.mul, den, power, "*")
+    node = num if isinstance(den, CFunc) else resolve_bfunc(operator.truediv, num, den, "/")
+    remember_form(product_forms, node, (1, bases))
+    return node
+
+def add_term(terms, term, c):
+    c = number(terms.get(term, 0) + c)
+    if c == 0:
+        terms.pop(term, None)
+    else:
+        terms[term] = c
+
+def pythagoras(terms):
+    # c1 sin(a)^n r + c2 cos(a)^2 sin(a)^(n-2) r
+    #     = c2 sin(a)^(n-2) r + (c1 - c2) sin(a)^n r
+    for term in list(terms):
+        if term not in terms:
+            continue
+        bases = product_form(term)[1]
+        for s, e in bases.items():
+            if not (isinstance(s, UFunc) and s.op == Op.SIN and isinstance(e, int) and e >= 2):
+                continue
+            rest = dict(bases)
+            if e == 2:
+                del rest[s]
+            else:
+                rest[s] = e - 2
+            other = dict(rest)
+            cos = resolve_ufunc(np.cos, s.body, "cos")
+            other[cos] = other.get(cos, 0) + 2
+            partner = product_node(other)
+            if partner in terms:
+                c2 = terms.pop(partner)
+                add_term(terms, term, -c2)
+                add_term(terms, product_node(rest), c2)
+                break
+    return terms
+
+def sum_node(const, terms):
+    # canonical sum: terms in canonical order, then the constant
+    terms = pythagoras(dict(terms))
+    const = number(const + terms.pop(CFunc(1), 0))
+    node = None
+    for term in canonical_order(terms):
+        c = terms[term]
+        if node is None and c == -1:
+            node = resolve_ufunc(operator.neg, term, "-")
+        elif node is None:
+            node = resolve_bfunc(operator.mul, CFunc(c), term, "*")
+        elif c < 0:
+            node = resolve_bfunc(operator.sub, node, resolve_bfunc(operator.mul, CFunc(-c), term, "*"), "-")
+        else:
+            node = resolve_bfunc(operator.add, node, resolve_bfunc(operator.mul, CFunc(c), term, "*"), "+")
+    if node is None:
+        return CFunc(const)
+    if const < 0:
+        node = resolve_bfunc(operator.sub, node, CFunc(-const), "-")
+    elif const > 0:
+        node = resolve_bfunc(operator.add, node, CFunc(const), "+")
+    remember_form(sum_forms, node, (const, terms))
+    return node
+
+def is_negative(exp):
+    # every coefficient of the sum below zero, as in -x or -2x - 1
+    const, terms = sum_form(exp)
+    coefs = list(terms.values()) + ([const] if const != 0 else [])
+    return len(coefs) > 0 and all(c < 0 for c in coefs)
+
+def simplify_node(exp, kids):
+    # exp with its children already replaced by their canonical forms
+    if isinstance(exp, CFunc):
+        return CFunc(number(exp.num))
+    if isinstance(exp, (Symb, Poly)):
+        return exp
+    if isinstance(exp, UFunc):
+        body, = kids
+        if isinstance(body, CFunc) or exp.op in (Op.NEG, Op.SQRT):
+            return sum_node(*sum_form(resolve_ufunc(exp.func, body, exp.funcsymb)))
+        if exp.op in (Op.SIN, Op.COS) and is_negative(body):
+            # sin(-a) = -sin(a), cos(-a) = cos(a)
+            body = sum_node(*merge_sums((0, {}), sum_form(body), -1))
+            res = resolve_ufunc(exp.func, body, exp.funcsymb)
+            return sum_node(0, {res: -1 if exp.op == Op.SIN else 1})
+        return resolve_ufunc(exp.func, body, exp.funcsymb)
+    left, right = kids
+    if exp.op in (Op.ADD, Op.SUB):
+        return sum_node(*merge_sums(sum_form(left), sum_form(right), 1 if exp.op == Op.ADD else -1))
+    if exp.op == Op.DIV and product_form(right)[0] == 0:
+        # keep division by zero as it is, it evaluates to inf or nan
+        return BFunc(exp.func, left, right, exp.funcsymb)
+    if exp.op == Op.POW and not isinstance(right, CFunc):
+        return resolve_bfunc(exp.func, left, right, exp.funcsymb)
+    if exp.op == Op.POW:
+        coef, bases = power_form(left, number(right.num), BFunc(exp.func, left, right, exp.funcsymb))
+    else:
+        coef, bases = merge_products(product_form(left), product_form(right), 1 if exp.op == Op.MUL else -1)
+    return sum_node(0, {product_node(bases): coef} if coef != 0 else {})
+
+def simplify(exp):
+    # canonical form of exp: sums and products flattened, constants
+    # folded, like terms and powers collected and sin^2 + cos^2 = 1,
+    # memoized per node so shared subexpressions are simplified once
+    exp = to_node(exp)
+    if exp in canonical:
+        return exp
+    res = simplified.get(exp)
+    if res is None:
+        if isinstance(exp, UFunc):
+            kids = [simplify(exp.body)]
+        elif isinstance(exp, BFunc):
+            kids = [simplify(exp.left), simplify(exp.right)]
+        else:
+            kids = []
+        res = simplify_node(exp, kids)
+        if res is not exp:
+            simplified[exp] = res
+        canonical.add(res)
+    return res
+
+class DiffCache:
+
+    # bounded (node, variable) -> derivative table with least recently used
+    # eviction, so shared subtrees and repeated diff calls are derived once
+
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def lookup(self, exp, var, derive):
+        key = (exp, var.symb)
+        res = self.entries.get(key)
+        if res is not None:
+            self.entries.move_to_end(key)
+            return res
+        res = derive(var)
+        self.entries[key] = res
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return res
+
+    def clear(self):
+        self.entries.clear()
+
+diff_cache = DiffCache()
 
 def accumulate(null, op, lst):
     if lst == []:
         return null
     return op(lst[0], accumulate(null, op, lst[1:]))
 
+def evaluate_points(kernel, vars, P, order, dim, chunk):
+    # kernel maps {symbol: array} to dim arrays; P is (N, k) with one column
+    # per name in order (the sorted variables by default), a 1-d P holds N
+    # values of a single variable. points go through in chunks of rows,
+    # so temporaries stay bounded for any N
+    if order is None:
+        names = sorted(vars)
+    else:
+        names = [o.symb if isinstance(o, Symb) else o for o in order]
+    missing = set(vars) - set(names)
+    assert not missing, AssertionError(f"no column for {sorted(missing)}")
+
+    P = np.asarray(P, dtype=float)
+    if P.ndim == 1 and len(names) == 1:
+        P = P[:, None]
+    assert P.ndim == 2 and P.shape[1] == len(names), AssertionError(f"points of shape {P.shape} for variables {names}")
+
+    out = np.empty((len(P), dim))
+    for start in range(0, len(P), chunk):
+        # one contiguous row per variable
+        cols = np.ascontiguousarray(P[start:start + chunk].T)
+        values = kernel({name: col for name, col in zip(names, cols)})
+        for i, val in enumerate(values):
+            out[start:start + chunk, i] = val
+    return out
+
+# node -> compiled callable, shared by every user of an interned node
+kernels = weakref.WeakKeyDictionary()
+
+def compile_node(exp):
+    kernel = kernels.get(exp)
+    if kernel is None:
+        lowered = lower_kernel([exp])
+        kernel = lambda vars: lowered(vars)[0]
+        kernels[exp] = kernel
+    return kernel
+
+def schedule(exprs):
+    # common subexpression elimination over all expressions together: every
+    # distinct (interned) node appears once, after the nodes it depends on
+    order = []
+    index = {}
+
+    def visit(root):
+        # post-order walk with an explicit stack, so long chains built in
+        # a loop do not hit the recursion limit
+        stack = [(root, False)]
+        while stack:
+            exp, ready = stack.pop()
+            if exp in index:
+                continue
+            if ready:
+                index[exp] = len(order)
+                order.append(exp)
+                continue
+            stack.append((exp, True))
+            if isinstance(exp, UFunc):
+                stack.append((exp.body, False))
+            elif isinstance(exp, BFunc):
+                stack.append((exp.right, False))
+                stack.append((exp.left, False))
+            elif isinstance(exp, Poly):
+                stack.extend((Symb(name), False) for name in reversed(exp.names))
+        return index[root]
+
+    outputs = [visit(to_node(exp)) for exp in exprs]
+    return order, index, outputs
+
+def arguments(exp, index):
+    # schedule slots of the children of exp
+    if isinstance(exp, UFunc):
+        return (index[exp.body],)
+    if isinstance(exp, BFunc):
+        return (index[exp.left], index[exp.right])
+    if isinstance(exp, Poly):
+        return tuple(index[Symb(name)] for name in exp.names)
+    return ()
+
+class Kernel:
+
+    # expressions lowered once into a flat list of steps, each step is
+    # (kind, payload, argument slots) and runs on whole numpy arrays.
+    # shared subexpressions are computed once per call and every
+    # temporary is dropped after its last use
+
+    def __init__(self, exprs):
+        order, index, self.outputs = schedule(exprs)
+        self.steps = [self.lower(exp, index) for exp in order]
+
+        # slots to release after each step
+        last_use = {}
+        for i, (kind, payload, args) in enumerate(self.steps):
+            for a in args:
+                last_use[a] = i
+        for out in self.outputs:
+            last_use.pop(out, None)
+        self.release = [[] for _ in self.steps]
+        for slot, i in last_use.items():
+            self.release[i].append(slot)
+
+    def lower(self, exp, index):
+        if isinstance(exp, CFunc):
+            return ("const", exp.num, ())
+        if isinstance(exp, Symb):
+            return ("var", exp.symb, ())
+        # exp is UFunc, BFunc or Poly
+        return ("call", exp.func, arguments(exp, index))
+
+    def __call__(self, vars):
+        # vars maps symbol strings to scalars or arrays of a common shape
+        shape = np.broadcast_shapes(*[np.shape(x) for x in vars.values()])
+        values = []
+        for (kind, payload, args), release in zip(self.steps, self.release):
+            if kind == "call":
+                values.append(payload(*[values[a] for a in args]))
+            elif kind == "var":
+                assert payload in vars, AssertionError(f"no value for {payload}")
+                values.append(vars[payload])
+            else:
+                values.append(payload)
+            for slot in release:
+                values[slot] = None
+
+        results = []
+        for out in self.outputs:
+            res = values[out]
+            if np.shape(res) != shape:
+                # constant components are spread over the whole grid
+                res = np.full(shape, res, dtype=float)
+            results.append(res)
+        return tuple(results)
+
+def allocate_registers(order, index, outputs):
+    # register per scheduled operation (None for symbols and constants), a
+    # register is handed on once the last reader of its value has run, so
+    # results of arguments dying at an operation can be computed in place
+    last_use = {}
+    for i, exp in enumerate(order):
+        for a in arguments(exp, index):
+            last_use[a] = i
+    for out in outputs:
+        last_use[out] = len(order) # outputs live forever
+
+    regs = []
+    free = []
+    count = 0
+    for i, exp in enumerate(order):
+        if isinstance(exp, (Symb, CFunc)):
+            regs.append(None)
+            continue
+        for a in set(arguments(exp, index)):
+            if last_use[a] == i and regs[a] is not None:
+                free.append(regs[a])
+        if free:
+            regs.append(free.pop())
+        else:
+            regs.append(count)
+            count += 1
+    return regs, count
+
+# ufunc of each opcode, so that instructions can write into
+# preallocated buffers
+PROGRAM_OPS = (np.sin, np.cos, np.sqrt, np.log, np.negative,
+               np.add, np.subtract, np.multiply, np.true_divide, np.power)
+
+class Program:
+
+    # expressions linearized into an instruction array of rows
+    # (opcode, destination, argument, argument) over one slot space:
+    # variables first, then the constant pool, then registers. registers
+    # are shared between temporaries whose lifetimes do not overlap and
+    # their buffers are kept between calls on grids of the same shape.
+    # only numpy arrays, strings and ints are stored, so programs are
+    # compact and pickle without the expression graph
+
+    def __init__(self, exprs):
+        order, index, outputs = schedule([expand_polys(e) for e in exprs])
+        self.variables = tuple(sorted({exp.symb for exp in order if isinstance(exp, Symb)}))
+        consts = {}
+        for exp in order:
+            if isinstance(exp, CFunc):
+                consts.setdefault(float(exp.num), len(consts))
+        self.consts = np.array(list(consts), dtype=float)
+        base = len(self.variables) + len(consts)
+
+        regs, self.registers = allocate_registers(order, index, outputs)
+        var_slot = {v: i for i, v in enumerate(self.variables)}
+        slots = []
+        code = []
+        for exp, reg in zip(order, regs):
+            if isinstance(exp, Symb):
+                slots.append(var_slot[exp.symb])
+            elif isinstance(exp, CFunc):
+                slots.append(len(self.variables) + consts[float(exp.num)])
+            else:
+                args = [slots[a] for a in arguments(exp, index)]
+                dst = base + reg
+                slots.append(dst)
+                code.append((exp.op, dst, args[0], args[1] if len(args) > 1 else -1))
+
+        self.code = np.array(code, dtype=np.int32).reshape(-1, 4)
+        self.outputs = np.array([slots[out] for out in outputs], dtype=np.int32)
+        self.scratch = None
+
+    def __len__(self):
+        return len(self.code)
+
+    def __getstate__(self):
+        # register buffers are rebuilt on first call after unpickling
+        state = self.__dict__.copy()
+        state["scratch"] = None
+        return state
+
+    def buffers(self, shape, fresh):
+        # fresh output registers get new arrays every call, the others are reused
+        base = len(self.variables) + len(self.consts)
+        if self.scratch is None or self.scratch[0] != shape:
+            self.scratch = (shape, [np.empty(shape) for _ in range(self.registers)])
+        regs = list(self.scratch[1])
+        if fresh:
+            for out in set(self.outputs.tolist()):
+                if out >= base:
+                    regs[out - base] = np.empty(shape)
+        return regs
+
+    def __call__(self, vars, fresh=True):
+        # vars maps symbol strings to scalars or arrays of a common shape.
+        # without fresh the results live in the register buffers and are
+        # overwritten by the next call, for callers that copy them right away
+        for v in self.variables:
+            assert v in vars, AssertionError(f"no value for {v}")
+        shape = np.broadcast_shapes(*[np.shape(x) for x in vars.values()])
+        slots = [vars[v] for v in self.variables] + list(self.consts) + self.buffers(shape, fresh)
+        ops = PROGRAM_OPS
+        for op, dst, a, b in self.code.tolist():
+            if b < 0:
+                ops[op](slots[a], out=slots[dst])
+            else:
+                ops[op](slots[a], slots[b], out=slots[dst])
+
+        results = []
+        for out in self.outputs.tolist():
+            res = slots[out]
+            if np.shape(res) != shape or out < len(self.variables):
+                # constant and bare variable outputs are copied over the grid
+                res = np.broadcast_to(np.asarray(res, dtype=float), shape).copy()
+            results.append(res)
+        return tuple(results)
+
+# directory of the persistent code cache, off unless configured
+code_cache_dir = os.environ.get("EXPR_CODE_CACHE")
+
+# part of every cache key: bump it whenever generate_source (or the
+# lowering it runs on) emits different code for the same expressions
+CODE_FORMAT = 1
+
+# node -> hex digest of its structure, stable across processes
+digests = weakref.WeakKeyDictionary()
+
+# digest -> code object, shared by every kernel of the same expressions,
+# the least recently used ones are dropped beyond max_code_objects
+code_objects = OrderedDict()
+max_code_objects = 1024
+
+def structural_digest(exp):
+    # memoized per node, so digests of derived trees only hash the new nodes
+    exp = to_node(exp)
+    digest = digests.get(exp)
+    if digest is not None:
+        return digest
+    if isinstance(exp, CFunc):
+        text = repr(("c", float(exp.num)))
+    elif isinstance(exp, Symb):
+        text = repr(("s", exp.symb))
+    elif isinstance(exp, Poly):
+        text = repr(("p", exp.terms))
+    elif isinstance(exp, UFunc):
+        text = repr(("u", exp.funcsymb, structural_digest(exp.body)))
+    else:
+        text = repr(("b", exp.funcsymb, structural_digest(exp.left), structural_digest(exp.right)))
+    digest = digests[exp] = hashlib.sha1(text.encode()).hexdigest()
+    return digest
+
+def generate_source(exprs):
+    # straight-line numpy source of a function mapping the variable
+    # values, in sorted order, to a tuple with one value per expression
+    order, index, outputs = schedule([expand_polys(e) for e in exprs])
+    variables = sorted({exp.symb for exp in order if isinstance(exp, Symb)})
+    var_name = {v: f"v{i}" for i, v in enumerate(variables)}
+    regs, count = allocate_registers(order, index, outputs)
+
+    lines = [f"def kernel({', '.join(var_name[v] for v in variables)}):"]
+    names = []
+    for exp, reg in zip(order, regs):
+        if isinstance(exp, Symb):
+            names.append(var_name[exp.symb])
+            continue
+        if isinstance(exp, CFunc):
+            num = float(exp.num)
+            names.append(repr(num) if np.isfinite(num) else f"float('{num}')")
+            continue
+        args = ", ".join(names[a] for a in arguments(exp, index))
+        op = PROGRAM_OPS[exp.op]
+        names.append(f"r{reg}")
+        lines.append(f"    r{reg} = {op.__name__}({args})")
+    lines.append(f"    return ({''.join(names[out] + ', ' for out in outputs)})")
+    return "\n".join(lines) + "\n", variables
+
+def load_code(exprs):
+    # code object of the generated source, looked up in memory, then on
+    # disk under the structural digest, and only generated when missing
+    # the operations the source calls are keyed too, by name
+    key = [f"format {CODE_FORMAT}", ",".join(op.__name__ for op in PROGRAM_OPS)]
+    digest = hashlib.sha1(" ".join(key + [structural_digest(e) for e in exprs]).encode()).hexdigest()
+    code = code_objects.get(digest)
+    if code is not None:
+        code_objects.move_to_end(digest)
+        return code
+
+    path = None
+    if code_cache_dir is not None:
+        path = os.path.join(code_cache_dir, f"{digest}.{sys.implementation.cache_tag}.bin")
+        try:
+            with open(path, "rb") as file:
+                code = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+
+    if code is None:
+        source, variables = generate_source(exprs)
+        code = compile(source, f"<kernel {digest[:12]}>", "exec")
+        if path is not None:
+            os.makedirs(code_cache_dir, exist_ok=True)
+            # written aside and renamed, so concurrent workers never read half a file
+            tmp = f"{path}.{os.getpid()}"
+            with open(tmp, "wb") as file:
+                marshal.dump(code, file)
+            os.replace(tmp, path)
+    code_objects[digest] = code
+    if len(code_objects) > max_code_objects:
+        code_objects.popitem(last=False)
+    return code
+
+class SourceKernel:
+
+    # same interface as Kernel, running the generated straight-line source
+    # instead of interpreting the steps
+
+    def __init__(self, exprs):
+        exprs = [to_node(e) for e in exprs]
+        self.variables = sorted(accumulate(frozenset(), merge_vars, [get_vars(e) for e in exprs]))
+        namespace = {op.__name__: op for op in PROGRAM_OPS}
+        exec(load_code(exprs), namespace)
+        self.func = namespace["kernel"]
+
+    def __call__(self, vars):
+        # vars maps symbol strings to scalars or arrays of a common shape
+        for v in self.variables:
+            assert v in vars, AssertionError(f"no value for {v}")
+        shape = np.broadcast_shapes(*[np.shape(x) for x in vars.values()])
+        results = []
+        for res in self.func(*[vars[v] for v in self.variables]):
+            if np.shape(res) != shape:
+                # constant components are spread over the whole grid
+                res = np.full(shape, res, dtype=float)
+            results.append(res)
+        return tuple(results)
+
+def lower_kernel(exprs):
+    # generated source when the code cache is configured, steps otherwise
+    if code_cache_dir is not None:
+        return SourceKernel(exprs)
+    return Kernel(exprs)
+
+# program of the grid evaluation in a worker process, set by its initializer
+grid_program = None
+
+def init_grid_worker(program):
+    global grid_program
+    grid_program = program
+
+def fill_grid_rows(kernel, out, axes, start, stop):
+    # rows start:stop of the first axis of a tensor grid, one trailing
+    # column of out per expression
+    dims = len(axes)
+    vars = {}
+    for i, (name, coords) in enumerate(axes):
+        if i == 0:
+            coords = coords[start:stop]
+        vars[name] = np.reshape(coords, [-1 if j == i else 1 for j in range(dims)])
+    for k, res in enumerate(kernel(vars)):
+        out[start:stop, ..., k] = res
+
+def grid_tile(name, shape, axes, start, stop):
+    # runs in a worker, writing straight into the shared output
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, dtype=float, buffer=memory.buf)
+        fill_grid_rows(grid_program, out, axes, start, stop)
+        del out
+    finally:
+        memory.close()
+
+class GridPool:
+
+    # expressions evaluated over tensor grids by a pool of worker processes.
+    # the program is sent once to every worker; a grid is cut into tiles of
+    # rows along its first axis, and each worker writes its tiles into one
+    # shared memory output, so only the axes travel and nothing is sent back.
+    # workers keep their register buffers between tiles of the same shape
+
+    def __init__(self, exprs, workers=None, tile_bytes=4 * 2**20):
+        self.program = Program([to_node(e) for e in exprs])
+        self.dim = len(exprs)
+        self.workers = workers or os.cpu_count()
+        self.tile_bytes = tile_bytes
+        self.pool = ProcessPoolExecutor(self.workers, initializer=init_grid_worker, initargs=(self.program,))
+
+    def __call__(self, axes, out=None):
+        # axes are (symbol, 1-d coordinates) pairs, the result is shaped
+        # (*lengths, dim) like the tensor grid they span; out is an optional
+        # float array of that shape to write it into
+        axes = [(name.symb if isinstance(name, Symb) else name, np.asarray(coords, dtype=float)) for name, coords in axes]
+        shape = tuple(len(coords) for _, coords in axes) + (self.dim,)
+        out = grid_output(out, shape)
+        size = out.size
+        if size == 0:
+            return out
+
+        # enough tiles to keep every worker busy, none larger than tile_bytes
+        row_bytes = 8 * size // shape[0]
+        rows = max(1, min(self.tile_bytes // row_bytes, -(-shape[0] // (4 * self.workers))))
+
+        memory = shared_memory.SharedMemory(create=True, size=8 * size)
+        try:
+            tiles = [
+                self.pool.submit(grid_tile, memory.name, shape, axes, start, min(start + rows, shape[0]))
+                for start in range(0, shape[0], rows)
+            ]
+            for tile in tiles:
+                tile.result()
+            # the result is copied out of shared memory: one pass over it,
+            # cheap next to evaluating the program, and the segment is then
+            # unlinked at once instead of staying mapped for as long as any
+            # slice of the result lives. callers that evaluate many grids
+            # pass out to reuse one destination rather than allocate each time
+            view = np.ndarray(shape, dtype=float, buffer=memory.buf)
+            np.copyto(out, view)
+            del view
+        finally:
+            memory.close()
+            memory.unlink()
+        return out
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ThreadGrid:
+
+    # same interface as GridPool with threads instead of processes: numpy
+    # ufuncs release the gil while they run over whole arrays, so tiles run
+    # in parallel and nothing is pickled. tiles are sized for the registers
+    # of one tile to fit in cache_bytes. every thread runs its own copy of
+    # the program, whose register buffers it reuses for all its tiles
+
+    def __init__(self, exprs, threads=None, cache_bytes=2 * 2**20):
+        self.program = Program([to_node(e) for e in exprs])
+        self.dim = len(exprs)
+        self.threads = threads or os.cpu_count()
+        self.tile_points = max(1024, cache_bytes // (8 * max(1, self.program.registers)))
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(self.threads)
+
+    def thread_program(self):
+        program = getattr(self.local, "program", None)
+        if program is None:
+            # copies start without scratch, see Program.__getstate__
+            program = self.local.program = copy.copy(self.program)
+        return program
+
+    def tile(self, out, axes, start, stop):
+        program = self.thread_program()
+        # results are copied into out straight away, so the output registers are reused too
+        fill_grid_rows(lambda vars: program(vars, fresh=False), out, axes, start, stop)
+
+    def __call__(self, axes, out=None):
+        # axes are (symbol, 1-d coordinates) pairs, the result is shaped
+        # (*lengths, dim) like the tensor grid they span; tiles are written
+        # straight into out when it is given
+        axes = [(name.symb if isinstance(name, Symb) else name, np.asarray(coords, dtype=float)) for name, coords in axes]
+        shape = tuple(len(coords) for _, coords in axes) + (self.dim,)
+        out = grid_output(out, shape)
+        if out.size == 0:
+            return out
+
+        # whole rows of the first axis, about tile_points per tile; equal
+        # tiles share one shape, so the buffers are not rebuilt between them
+        rows = max(1, self.tile_points * self.dim // (out.size // shape[0]))
+        tiles = [
+            self.pool.submit(self.tile, out, axes, start, min(start + rows, shape[0]))
+            for start in range(0, shape[0], rows)
+        ]
+        for tile in tiles:
+            tile.result()
+        return out
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def grid_output(out, shape):
+    # destination of a grid evaluation, a new array unless one is given
+    if out is None:
+        return np.empty(shape)
+    assert out.shape == shape and out.dtype == float, AssertionError(f"out must be a float array of shape {shape}")
+    return out
+
+def grid_pool(exprs, workers, threads):
+    # threads take precedence, they are the lighter of the two
+    if threads is not None:
+        return ThreadGrid(exprs, threads)
+    return GridPool(exprs, workers)
+
+def evaluate_grid(func, axes, workers=None, threads=None):
+    # components of a VFunc over the tensor grid of axes, shaped
+    # (*lengths, dim); in this process with its compiled kernel unless a
+    # worker process or thread count is given
+    if workers is None and threads is None:
+        axes = [(name.symb if isinstance(name, Symb) else name, np.asarray(coords, dtype=float)) for name, coords in axes]
+        out = np.empty(tuple(len(coords) for _, coords in axes) + (func.dim,))
+        fill_grid_rows(func.compile(), out, axes, 0, len(out))
+        return out
+    with grid_pool(func.funcs, workers, threads) as pool:
+        return pool(axes)
+
+class Tape:
+
+    # numeric automatic differentiation over the schedule of a set of
+    # expressions: values and the full jacobian come out of one pass over
+    # whole arrays, without building any derivative trees
+
+    def __init__(self, exprs):
+        self.order, index, self.outputs = schedule(exprs)
+        self.args = [arguments(exp, index) for exp in self.order]
+
+    def values(self, vars):
+        # plain evaluation, keeping every intermediate for the derivative pass
+        vals = []
+        for exp, args in zip(self.order, self.args):
+            if isinstance(exp, CFunc):
+                vals.append(exp.num)
+            elif isinstance(exp, Symb):
+                assert exp.symb in vars, AssertionError(f"no value for {exp.symb}")
+                vals.append(np.asarray(vars[exp.symb], dtype=float))
+            else:
+                vals.append(exp.func(*[vals[a] for a in args]))
+        return vals
+
+    def partial(self, exp, i, arg_vals, val):
+        # derivative of exp with respect to its i-th argument
+        if isinstance(exp, Poly):
+            d = exp.diff(Symb(exp.names[i]))
+            if isinstance(d, CFunc):
+                return d.num
+            return d.eval(dict(zip(exp.names, arg_vals)))
+        if isinstance(exp, UFunc):
+            a = arg_vals[0]
+            if exp.funcsymb == "sin":
+                return np.cos(a)
+            if exp.funcsymb == "cos":
+                return -np.sin(a)
+            if exp.funcsymb == "sqrt":
+                return 0.5 / val
+            if exp.funcsymb == "ln":
+                return 1 / a
+            if exp.funcsymb == "-":
+                return -1.0
+        else:
+            a, b = arg_vals
+            if exp.funcsymb == "+":
+                return 1.0
+            if exp.funcsymb == "-":
+                return 1.0 if i == 0 else -1.0
+            if exp.funcsymb == "*":
+                return b if i == 0 else a
+            if exp.funcsymb == "/":
+                return 1 / b if i == 0 else -val / b
+            if exp.funcsymb == "^":
+                return b * a ** (b - 1) if i == 0 else val * np.log(a)
+        raise AssertionError(f"no derivative rule for {exp.funcsymb}")
+
+    def forward(self, vars, wrt):
+        # one pass carrying the tangents along all k variables at once
+        vals = self.values(vars)
+        shape = np.broadcast_shapes(*[np.shape(x) for x in vars.values()])
+        pos = {w: j for j, w in enumerate(wrt)}
+
+        tangents = []
+        for exp, args, val in zip(self.order, self.args, vals):
+            tan = None
+            if isinstance(exp, Symb):
+                if exp.symb in pos:
+                    tan = np.zeros((len(wrt),) + shape)
+                    tan[pos[exp.symb]] = 1.0
+            else:
+                arg_vals = [vals[a] for a in args]
+                for i, a in enumerate(args):
+                    if tangents[a] is None:
+                        continue
+                    term = self.partial(exp, i, arg_vals, val) * tangents[a]
+                    tan = term if tan is None else tan + term
+            tangents.append(tan)
+
+        value = np.empty((len(self.outputs),) + shape)
+        jac = np.zeros((len(self.outputs), len(wrt)) + shape)
+        for row, out in enumerate(self.outputs):
+            value[row] = vals[out]
+            if tangents[out] is not None:
+                jac[row] = tangents[out]
+        return value, jac
+
+    def reverse(self, vars, wrt):
+        # one backward sweep per output, accumulating adjoints
+        vals = self.values(vars)
+        shape = np.broadcast_shapes(*[np.shape(x) for x in vars.values()])
+        pos = {w: j for j, w in enumerate(wrt)}
+
+        value = np.empty((len(self.outputs),) + shape)
+        jac = np.zeros((len(self.outputs), len(wrt)) + shape)
+        for row, out in enumerate(self.outputs):
+            value[row] = vals[out]
+            adjoints = [None] * (out + 1)
+            adjoints[out] = np.ones(shape)
+            for slot in range(out, -1, -1):
+                adj = adjoints[slot]
+                if adj is None:
+                    continue
+                exp = self.order[slot]
+                if isinstance(exp, Symb) and exp.symb in pos:
+                    jac[row, pos[exp.symb]] += adj
+                args = self.args[slot]
+                arg_vals = [vals[a] for a in args]
+                for i, a in enumerate(args):
+                    if isinstance(self.order[a], CFunc):
+                        continue
+                    term = self.partial(exp, i, arg_vals, vals[slot]) * adj
+                    adjoints[a] = term if adjoints[a] is None else adjoints[a] + term
+        return value, jac
+
+    def __call__(self, vars, wrt, mode="auto"):
+        # forward mode costs a pass per variable, reverse mode one per output
+        if mode == "auto":
+            mode = "forward" if len(wrt) <= len(self.outputs) else "reverse"
+        if mode == "forward":
+            return self.forward(vars, wrt)
+        return self.reverse(vars, wrt)
+
+class IntervalKernel:
+
+    # conservative interval evaluation of expressions over many boxes at once:
+    # every output (lo, hi) pair encloses the function on the matching box
+
+    def __init__(self, exprs):
+        self.order, index, self.outputs = schedule(exprs)
+        self.args = [arguments(exp, index) for exp in self.order]
+
+    def __call__(self, boxes):
+        # boxes maps symbol strings to (lo, hi) pairs of arrays
+        vals = []
+        with np.errstate(all="ignore"):
+            for exp, args in zip(self.order, self.args):
+                if isinstance(exp, CFunc):
+                    vals.append((exp.num, exp.num))
+                elif isinstance(exp, Symb):
+                    assert exp.symb in boxes, AssertionError(f"no interval for {exp.symb}")
+                    lo, hi = boxes[exp.symb]
+                    vals.append((np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)))
+                elif isinstance(exp, UFunc):
+                    vals.append(self.unary(exp, vals[args[0]]))
+                elif isinstance(exp, Poly):
+                    vals.append(self.poly(exp, [vals[a] for a in args]))
+                else:
+                    vals.append(self.binary(exp, vals[args[0]], vals[args[1]], self.order[args[1]]))
+
+        results = []
+        for out in self.outputs:
+            lo, hi = vals[out]
+            # nan means the enclosure is unknown
+            lo = np.where(np.isnan(lo), -np.inf, lo)
+            hi = np.where(np.isnan(hi), np.inf, hi)
+            results.append((lo, hi))
+        return results
+
+    def unary(self, exp, a):
+        lo, hi = a
+        if exp.funcsymb == "-":
+            return -hi, -lo
+        if exp.funcsymb == "sqrt":
+            return np.sqrt(np.maximum(lo, 0)), np.sqrt(np.maximum(hi, 0))
+        if exp.funcsymb == "ln":
+            return np.log(np.maximum(lo, 0)), np.log(np.maximum(hi, 0))
+        if exp.funcsymb == "sin":
+            return self.sin(lo, hi)
+        if exp.funcsymb == "cos":
+            return self.sin(lo + np.pi / 2, hi + np.pi / 2)
+        raise AssertionError(f"no interval rule for {exp.funcsymb}")
+
+    def sin(self, lo, hi):
+        # extremes are reached at the endpoints unless a peak or trough is inside
+        s_lo, s_hi = np.sin(lo), np.sin(hi)
+        res_lo = np.minimum(s_lo, s_hi)
+        res_hi = np.maximum(s_lo, s_hi)
+        two_pi = 2 * np.pi
+        has_peak = np.floor((hi - np.pi / 2) / two_pi) >= np.ceil((lo - np.pi / 2) / two_pi)
+        has_trough = np.floor((hi + np.pi / 2) / two_pi) >= np.ceil((lo + np.pi / 2) / two_pi)
+        return np.where(has_trough, -1.0, res_lo), np.where(has_peak, 1.0, res_hi)
+
+    def binary(self, exp, a, b, right):
+        (a_lo, a_hi), (b_lo, b_hi) = a, b
+        if exp.funcsymb == "+":
+            return a_lo + b_lo, a_hi + b_hi
+        if exp.funcsymb == "-":
+            return a_lo - b_hi, a_hi - b_lo
+        if exp.funcsymb == "*":
+            return self.mul(a_lo, a_hi, b_lo, b_hi)
+        if exp.funcsymb == "/":
+            spans_zero = (b_lo <= 0) & (b_hi >= 0)
+            lo, hi = self.mul(a_lo, a_hi, 1 / b_hi, 1 / b_lo)
+            return np.where(spans_zero, -np.inf, lo), np.where(spans_zero, np.inf, hi)
+        if exp.funcsymb == "^":
+            if isinstance(right, CFunc) and float(right.num).is_integer():
+                return self.int_pow(a_lo, a_hi, int(right.num))
+            # real powers are only defined for a nonnegative base and are
+            # monotone in each argument there
+            a_lo, a_hi = np.maximum(a_lo, 0), np.maximum(a_hi, 0)
+            return self.mul_like(np.power, a_lo, a_hi, b_lo, b_hi)
+        raise AssertionError(f"no interval rule for {exp.funcsymb}")
+
+    def poly(self, exp, intervals):
+        # sum of the monomial enclosures, even powers stay nonnegative
+        boxes = dict(zip(exp.names, intervals))
+        lo = hi = 0.0
+        for mono, c in exp.terms:
+            t_lo, t_hi = c, c
+            for name, e in mono:
+                t_lo, t_hi = self.mul(t_lo, t_hi, *self.int_pow(*boxes[name], e))
+            lo, hi = lo + t_lo, hi + t_hi
+        return lo, hi
+
+    def mul(self, a_lo, a_hi, b_lo, b_hi):
+        return self.mul_like(np.multiply, a_lo, a_hi, b_lo, b_hi)
+
+    def mul_like(self, op, a_lo, a_hi, b_lo, b_hi):
+        corners = [op(a_lo, b_lo), op(a_lo, b_hi), op(a_hi, b_lo), op(a_hi, b_hi)]
+        return np.minimum.reduce(corners), np.maximum.reduce(corners)
+
+    def int_pow(self, lo, hi, n):
+        if n < 0:
+            p_lo, p_hi = self.int_pow(lo, hi, -n)
+            spans_zero = (p_lo <= 0) & (p_hi >= 0)
+            return np.where(spans_zero, -np.inf, 1 / p_hi), np.where(spans_zero, np.inf, 1 / p_lo)
+        p_lo, p_hi = np.power(lo, n), np.power(hi, n)
+        if n % 2 == 1:
+            return p_lo, p_hi
+        # even powers dip to zero when the interval contains it
+        spans_zero = (lo <= 0) & (hi >= 0)
+        return np.where(spans_zero, 0.0, np.minimum(p_lo, p_hi)), np.maximum(p_lo, p_hi)
+
 class VFunc:
     def __init__(self, *funcs):
 
@@ -1140,10 +1978,13 @@ class VFunc:
         self.dim = len(funcs)
 
         # set of symbol objects
-        self.vars = accumulate(set(), lambda x, y: x | y, [f.vars for f in self.funcs])
+        self.vars = accumulate(frozenset(), merge_vars, [get_vars(f) for f in self.funcs])
         self.arity = len(self.vars)
+        self.kernel = None # compiled on first use
+        self.tape = None # built on first use
 
     def diff(self, var):
+        # components go through the shared derivative cache
         return VFunc(*[f.diff(var) for f in self.funcs])
     
     def norm(self):
@@ -1161,10 +2002,41 @@ class VFunc:
 
     def eval(self, vars):
         return tuple([f.eval(vars) for f in self.funcs])
+
+    def compile(self):
+        # callable mapping {symbol: array} to a tuple of arrays, one per component
+        if self.kernel is None:
+            self.kernel = lower_kernel(self.funcs)
+        return self.kernel
+
+    def to_program(self):
+        # compact picklable form of all components, see Program
+        return Program(self.funcs)
+
+    def simplify(self):
+        return VFunc(*[simplify(f) for f in self.funcs])
+
+    def value_and_jacobian(self, vars, wrt=None, mode="auto"):
+        # vars maps symbols to arrays of a common shape; returns the values
+        # with shape (dim, *shape) and the jacobian with shape (dim, k, *shape)
+        if self.tape is None:
+            self.tape = Tape(self.funcs)
+        if wrt is None:
+            wrt = sorted(self.vars)
+        wrt = [w.symb if isinstance(w, Symb) else w for w in wrt]
+        return self.tape(vars, wrt, mode)
     
     def eval_point(self, p):
-        assert all([len(p) >= k.arity for k in self.funcs]), AssertionError(f"len p: {len(p)}, arities: {[k.arity for k in self.funcs]}")
-        return self.eval({var : pcoord for var, pcoord in zip(list(self.vars), p)})
+        # p lists the variables in sorted order, extra trailing coordinates
+        # are ignored
+        p = tuple(p)[:self.arity]
+        assert len(p) == self.arity, AssertionError(f"len p: {len(p)}, arity: {self.arity}")
+        return tuple(self.eval_points([p])[0])
+
+    def eval_points(self, P, order=None, chunk=1 << 20):
+        # P is (N, k), its columns are the variables in order, sorted by
+        # default; returns an (N, dim) array
+        return evaluate_points(self.compile(), self.vars, P, order, self.dim, chunk)
     
     def __add__(self, other):
         assert self.dim == other.dim, AssertionError()
@@ -1204,6 +2076,11 @@ class VFunc:
         assert isinstance(other, (int, CFunc)), AssertionError()
         return VFunc(*[f * other for f in self.funcs])
 
+    def __truediv__(self, other):
+        # other is a scalar function
+        assert not isinstance(other, VFunc), AssertionError()
+        return VFunc(*[f / other for f in self.funcs])
+
     def __rmul__(self, other):
         assert isinstance(other, (int, CFunc)), AssertionError()
         return VFunc(*[f * other for f in self.funcs])
@@ -1229,6 +2106,37 @@ class VFunc:
 
         return result
 
+def grid_faces(nu, nv):
+
+    # two triangles per cell of an nv x nu row-major vertex grid
+    idx = np.arange(nu * nv, dtype=np.int32).reshape(nv, nu)
+    a = idx[:-1, :-1].ravel()
+    b = idx[:-1, 1:].ravel()
+    c = idx[1:, :-1].ravel()
+    d = idx[1:, 1:].ravel()
+    # the pair of each cell is kept adjacent, so a band of rows is a contiguous block
+    return np.stack([
+        np.column_stack([a, b, d]),
+        np.column_stack([a, d, c])
+    ], axis=1).reshape(-1, 3)
+
+def quadrature_weights(x):
+
+    # composite simpson weights on equally spaced x, with the trapezoid
+    # rule on the last interval when the amount of intervals is odd
+    n = len(x) - 1
+    h = x[1] - x[0]
+    w = np.zeros(n + 1)
+    even = n - n % 2
+    if even:
+        w[:even + 1:2] = 2 * h / 3
+        w[1:even:2] = 4 * h / 3
+        w[0] = w[even] = h / 3
+    if n % 2:
+        w[-2] += h / 2
+        w[-1] += h / 2
+    return w
+
 class Surface:
 
     def __init__(self, paramf):
@@ -1239,13 +2147,71 @@ class Surface:
         # assume first and second variable are in alphabetical order
         self.vars_list = sorted(list(self.paramf.vars))
 
-        self.df_1 = paramf.diff(Symb(self.vars_list[0]))
-        self.df_2 = paramf.diff(Symb(self.vars_list[1]))
+        # derived fields are kept in canonical form, everything compiled
+        # or differentiated from them downstream starts out smaller
+        self.df_1 = paramf.diff(Symb(self.vars_list[0])).simplify()
+        self.df_2 = paramf.diff(Symb(self.vars_list[1])).simplify()
 
         # not normalized
-        self.normal_vector = self.df_1.cross_prod(self.df_2)
+        self.normal_vector = self.df_1.cross_prod(self.df_2).simplify()
+
+        self.normal_vector_norm = (self.normal_vector / self.normal_vector.norm()).simplify()
+
+        self.form_kernel = None # compiled on first use
+
+    def fundamental_forms(self, U, V):
+
+        # coefficients E, F, G of the first and L, M, N of the second
+        # fundamental form, as arrays shaped like U and V broadcast together
+        if self.form_kernel is None:
+            u_symb = Symb(self.vars_list[0])
+            v_symb = Symb(self.vars_list[1])
+            vectors = [self.df_1, self.df_2, self.df_1.diff(u_symb).simplify(), self.df_1.diff(v_symb).simplify(), self.df_2.diff(v_symb).simplify()]
+            self.form_kernel = VFunc(*[f for vec in vectors for f in vec.funcs]).compile()
+
+        values = self.form_kernel({self.vars_list[0]: np.asarray(U, dtype=float), self.vars_list[1]: np.asarray(V, dtype=float)})
+        r_u, r_v, r_uu, r_uv, r_vv = [np.stack(values[3 * i:3 * i + 3], axis=-1) for i in range(5)]
+
+        normal = np.cross(r_u, r_v)
+        with np.errstate(all="ignore"):
+            normal = normal / np.linalg.norm(normal, axis=-1, keepdims=True)
+
+        def dot(a, b):
+            return np.sum(a * b, axis=-1)
 
-        self.normal_vector_norm = self.normal_vector / self.normal_vector.norm()
+        return (
+            dot(r_u, r_u), dot(r_u, r_v), dot(r_v, r_v),
+            dot(r_uu, normal), dot(r_uv, normal), dot(r_vv, normal)
+        )
+
+    def curvatures(self, U, V):
+
+        # area element, gaussian curvature and mean curvature in one pass
+        E, F, G, L, M, N = self.fundamental_forms(U, V)
+        det = E * G - F ** 2
+        with np.errstate(all="ignore"):
+            return (
+                np.sqrt(np.maximum(det, 0)),
+                (L * N - M ** 2) / det,
+                (E * N - 2 * F * M + G * L) / (2 * det)
+            )
+
+    def area_element(self, U, V):
+        return self.curvatures(U, V)[0]
+
+    def gaussian_curvature(self, U, V):
+        return self.curvatures(U, V)[1]
+
+    def mean_curvature(self, U, V):
+        return self.curvatures(U, V)[2]
+
+    def area(self, u_range, v_range, nu=257, nv=257):
+
+        # tensor product simpson rule over the area element
+        u = np.linspace(u_range[0], u_range[1], nu)
+        v = np.linspace(v_range[0], v_range[1], nv)
+        dA = self.area_element(u[None, :], v[:, None])
+        return np.sum(quadrature_weights(v)[:, None] * quadrature_weights(u)[None, :] * dA)
         
     def tangent_plane_cartesian(self, p):
         
@@ -1263,43 +2229,195 @@ class Surface:
     
     def tangent_plane_param(self, p):
 
-        # p is a point in coordinate space
-        # are tuples
-        df1_p = self.df_1.eval_point(p)
-        df2_p = self.df_2.eval_point(p)
+        # p is a point in parameter space, in the order of vars_list
+        positions, df_1, df_2, _ = self.tangent_planes([p])
+        F_p, df1_p, df2_p = positions[0], df_1[0], df_2[0]
 
-        p_u = int(p[0])
-        p_v = int(p[1])
+        p_u = float(p[0])
+        p_v = float(p[1])
 
         u_symb = Symb(self.vars_list[0])
         v_symb = Symb(self.vars_list[1])
 
-        # tuple
-        F_p = self.paramf.eval_point(p)
-
         return VFunc(
-            CFunc(F_p[0]) + (u_symb - p_v) * CFunc(df1_p[0]) + (v_symb - p_u) * CFunc(df2_p[0]),
-            CFunc(F_p[1]) + (u_symb - p_v) * CFunc(df1_p[1]) + (v_symb - p_u) * CFunc(df2_p[1]),
-            CFunc(F_p[2]) + (u_symb - p_v) * CFunc(df1_p[2]) + (v_symb - p_u) * CFunc(df2_p[2]),
+            CFunc(F_p[0]) + (u_symb - p_u) * CFunc(df1_p[0]) + (v_symb - p_v) * CFunc(df2_p[0]),
+            CFunc(F_p[1]) + (u_symb - p_u) * CFunc(df1_p[1]) + (v_symb - p_v) * CFunc(df2_p[1]),
+            CFunc(F_p[2]) + (u_symb - p_u) * CFunc(df1_p[2]) + (v_symb - p_v) * CFunc(df2_p[2]),
         )
+
+    def tangent_planes(self, P, chunk=1 << 14):
+
+        # P is an (N, 2) array of parameter points, columns in the order of vars_list
+        # returns (N, 3) arrays: positions, both tangent vectors and unit normals.
+        # the tape holds every intermediate value and tangent of the points it
+        # runs on, so they go through chunk rows at a time
+        P = np.asarray(P, dtype=float)
+        assert P.ndim == 2 and P.shape[1] == 2, AssertionError()
+
+        positions = np.empty((len(P), 3))
+        df_1 = np.empty((len(P), 3))
+        df_2 = np.empty((len(P), 3))
+        for start in range(0, len(P), chunk):
+            block = P[start:start + chunk]
+            value, jac = self.paramf.value_and_jacobian(
+                {self.vars_list[0]: block[:, 0], self.vars_list[1]: block[:, 1]},
+                wrt=self.vars_list
+            )
+            positions[start:start + chunk] = value.T
+            df_1[start:start + chunk] = jac[:, 0].T
+            df_2[start:start + chunk] = jac[:, 1].T
+
+        return positions, df_1, df_2, unit_normals(df_1, df_2)
     
-    def show(self, u_range, v_range, nu=200, nv=200, p_tangent_plane=None):
-        
-        # Parameter grids
+    def mesh(self, u_range, v_range, nu=200, nv=200, workers=None, threads=None):
+
+        # triangulated parameter grid without any plotting:
+        # (nu * nv, 3) float32 vertices, row-major over (v, u),
+        # (2 * (nu - 1) * (nv - 1), 3) int32 faces and (nu * nv, 3) float32 unit normals.
+        # with workers or threads the grid is evaluated in that many processes or threads
         u = np.linspace(u_range[0], u_range[1], nu)
         v = np.linspace(v_range[0], v_range[1], nv)
 
-        U, V = np.meshgrid(u, v)
-        
-        # Extract parameter symbols
-        vars = list(self.paramf.vars)
-        u_symb = vars[0]
-        v_symb = vars[1]
+        if workers is None and threads is None:
+            U, V = np.meshgrid(u, v)
+            positions, _, _, normals = self.tangent_planes(np.column_stack([U.ravel(), V.ravel()]))
+        else:
+            func = VFunc(*self.paramf.funcs, *self.df_1.funcs, *self.df_2.funcs)
+            values = evaluate_grid(func, [(self.vars_list[1], v), (self.vars_list[0], u)], workers, threads).reshape(-1, 9)
+            positions = values[:, 0:3]
+            normals = unit_normals(values[:, 3:6], values[:, 6:9])
+
+        return positions.astype(np.float32), grid_faces(nu, nv), normals.astype(np.float32)
+
+    def mesh_adaptive(self, u_range, v_range, tol=1e-3, max_angle=np.pi / 12, max_depth=8, base=4):
+
+        # quadtree over the parameter domain, starting from base cells per axis (int or pair):
+        # a cell is split while its chordal error (surface against the bilinear
+        # patch of its corners, at the center and edge midpoints) exceeds tol or
+        # its normals turn by more than max_angle, at most max_depth times.
+        # returns the same arrays as mesh(); the triangulation is crack free
+        base = np.array((base, base) if isinstance(base, int) else base)
+        lows = np.array([u_range[0], v_range[0]], dtype=float)
+        res = base * 2 ** max_depth # lattice cells per axis at the finest level
+        scale = (np.array([u_range[1], v_range[1]], dtype=float) - lows) / res
+
+        # corners, center, then the bottom, left, right and top edge midpoints
+        probe = np.array([[0, 0], [1, 0], [0, 1], [1, 1], [.5, .5], [.5, 0], [0, .5], [1, .5], [.5, 1]])
+        chords = [(4, [0, 1, 2, 3]), (5, [0, 1]), (6, [0, 2]), (7, [1, 3]), (8, [2, 3])]
+        min_cos = np.cos(max_angle)
+
+        size = 2 ** max_depth
+        ii, jj = np.meshgrid(np.arange(base[0]) * size, np.arange(base[1]) * size)
+        cells = np.column_stack([ii.ravel(), jj.ravel()])
+        leaves, leaf_sizes = [], []
+        while len(cells):
+            P = lows + (cells[:, None, :] + probe[None] * size) * scale
+            pos, _, _, normals = self.tangent_planes(P.reshape(-1, 2))
+            pos = pos.reshape(len(cells), len(probe), 3)
+            normals = normals.reshape(len(cells), len(probe), 3)
+
+            err = np.zeros(len(cells))
+            for mid, ends in chords:
+                err = np.maximum(err, np.linalg.norm(pos[:, mid] - pos[:, ends].mean(axis=1), axis=1))
+            # degenerate (zero) normals do not count as turning
+            cos = np.einsum("nk,nck->nc", normals[:, 4], normals[:, :4])
+            flat = np.all((cos >= min_cos) | (cos == 0), axis=1)
+
+            split = ((err > tol) | ~flat) & (size > 1)
+            leaves.append(cells[~split])
+            leaf_sizes.append(np.full((~split).sum(), size))
+
+            half = size // 2
+            cells = (cells[split][:, None, :] + np.array([[0, 0], [half, 0], [0, half], [half, half]])[None]).reshape(-1, 2)
+            size = half
+
+        leaves = np.concatenate(leaves)
+        sizes = np.concatenate(leaf_sizes)
+        return self.triangulate_cells(leaves, sizes, lows, scale, res.max() + 1)
+
+    def triangulate_cells(self, corners, sizes, lows, scale, width):
+
+        # square cells on an integer lattice with coordinates below width; a cell
+        # whose edges carry corners of smaller neighbours becomes a fan around
+        # its center, the rest two triangles
+        quad = np.array([[0, 0], [1, 0], [0, 1], [1, 1]])
+        lattice = (corners[:, None, :] + quad[None] * sizes[:, None, None]).reshape(-1, 2)
+        keys = np.unique(lattice[:, 0] * width + lattice[:, 1])
+        points = np.column_stack([keys // width, keys % width])
+        # the same points keyed row first, for the horizontal edges
+        keys_h = np.sort(points[:, 1] * width + points[:, 0])
+
+        def vertex(i, j):
+            return np.searchsorted(keys, i * width + j)
+
+        i0, j0 = corners[:, 0], corners[:, 1]
+        i1, j1 = i0 + sizes, j0 + sizes
+        hanging = (
+            np.searchsorted(keys_h, j0 * width + i1) - np.searchsorted(keys_h, j0 * width + i0 + 1)
+            + np.searchsorted(keys_h, j1 * width + i1) - np.searchsorted(keys_h, j1 * width + i0 + 1)
+            + np.searchsorted(keys, i0 * width + j1) - np.searchsorted(keys, i0 * width + j0 + 1)
+            + np.searchsorted(keys, i1 * width + j1) - np.searchsorted(keys, i1 * width + j0 + 1)
+        )
+
+        a, b, c, d = vertex(i0, j0), vertex(i1, j0), vertex(i0, j1), vertex(i1, j1)
+        plain = hanging == 0
+        faces = [
+            np.stack([
+                np.column_stack([a, b, d])[plain],
+                np.column_stack([a, d, c])[plain]
+            ], axis=1).reshape(-1, 3)
+        ]
+
+        # fans, boundary walked counter clockwise in (u, v)
+        centers = []
+        for n, cell in enumerate(np.flatnonzero(~plain)):
+            ci0, cj0, ci1, cj1 = i0[cell], j0[cell], i1[cell], j1[cell]
+            bottom = keys_h[np.searchsorted(keys_h, cj0 * width + ci0):np.searchsorted(keys_h, cj0 * width + ci1)] % width
+            right = keys[np.searchsorted(keys, ci1 * width + cj0):np.searchsorted(keys, ci1 * width + cj1)] % width
+            top = keys_h[np.searchsorted(keys_h, cj1 * width + ci0 + 1):np.searchsorted(keys_h, cj1 * width + ci1 + 1)] % width
+            left = keys[np.searchsorted(keys, ci0 * width + cj0 + 1):np.searchsorted(keys, ci0 * width + cj1 + 1)] % width
+            ring = np.concatenate([
+                vertex(bottom, cj0),
+                vertex(ci1, right),
+                vertex(top[::-1], cj1),
+                vertex(ci0, left[::-1])
+            ])
+            center = len(points) + n
+            faces.append(np.column_stack([ring, np.roll(ring, -1), np.full(len(ring), center)]))
+            centers.append(((ci0 + ci1) / 2, (cj0 + cj1) / 2))
+
+        params = np.concatenate([points, np.reshape(centers, (-1, 2))]) * scale + lows
+        positions, _, _, normals = self.tangent_planes(params)
+        return positions.astype(np.float32), np.concatenate(faces).astype(np.int32), normals.astype(np.float32)
+
+    def export(self, path, u_range, v_range, nu=200, nv=200, tile_rows=64):
+
+        # streams the same mesh as mesh() to a .ply, .stl or .obj file,
+        # tile_rows rows of the parameter grid at a time
+        assert nu >= 2 and nv >= 2, AssertionError()
+        writer = mesh_writer(path, nu * nv, 2 * (nu - 1) * (nv - 1))
+
+        u = np.linspace(u_range[0], u_range[1], nu)
+        v = np.linspace(v_range[0], v_range[1], nv)
+
+        face_start = 0
+        for j0 in range(0, nv - 1, tile_rows):
+            # neighbouring tiles share a row, owned by the later one
+            j1 = min(j0 + tile_rows, nv - 1)
+            U, V = np.meshgrid(u, v[j0:j1 + 1])
+            positions, _, _, normals = self.tangent_planes(np.column_stack([U.ravel(), V.ravel()]))
+
+            faces = grid_faces(nu, j1 - j0 + 1)
+            owned = (j1 - j0 + (j1 == nv - 1)) * nu
+            writer.write(j0 * nu, positions, normals, owned, face_start, faces)
+            face_start += len(faces)
+
+        writer.close()
+
+    def show(self, u_range, v_range, nu=200, nv=200, p_tangent_plane=None, workers=None, threads=None):
         
-        # Vectorized evaluation
-        X = np.vectorize(lambda ui, vi: self.paramf.funcs[0].eval({u_symb: ui, v_symb: vi}))(U, V)
-        Y = np.vectorize(lambda ui, vi: self.paramf.funcs[1].eval({u_symb: ui, v_symb: vi}))(U, V)
-        Z = np.vectorize(lambda ui, vi: self.paramf.funcs[2].eval({u_symb: ui, v_symb: vi}))(U, V)
+        verts, _, _ = self.mesh(u_range, v_range, nu, nv, workers, threads)
+        X, Y, Z = [verts[:, i].reshape(nv, nu) for i in range(3)]
         
         # Plot 3D surface
         fig = plt.figure(figsize=(10, 8))
@@ -1308,16 +2426,138 @@ class Surface:
 
         if p_tangent_plane is not None:
 
+            # Parameter grids
+            u = np.linspace(u_range[0], u_range[1], nu)
+            v = np.linspace(v_range[0], v_range[1], nv)
+            U, V = np.meshgrid(u, v)
+
             plane = self.tangent_plane_param(p_tangent_plane)
 
-            X = np.vectorize(lambda ui, vi: plane.funcs[0].eval({u_symb: ui, v_symb: vi}))(U, V)
-            Y = np.vectorize(lambda ui, vi: plane.funcs[1].eval({u_symb: ui, v_symb: vi}))(U, V)
-            Z = np.vectorize(lambda ui, vi: plane.funcs[2].eval({u_symb: ui, v_symb: vi}))(U, V)
+            X, Y, Z = plane.compile()({self.vars_list[0]: U, self.vars_list[1]: V})
 
             ax.plot_surface(X, Y, Z, alpha=0.8, linewidth=0, antialiased=True)
 
         plt.show()
 
+def unit_normals(df_1, df_2):
+
+    # (N, 3) tangent vectors to unit normals; degenerate points
+    # (e.g. the poles of a sphere) get a zero normal
+    normals = np.cross(df_1, df_2)
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, norms, out=np.zeros_like(normals), where=norms > 0)
+
+def sample_curve(curve, t_range, tol, pilot, refine):
+
+    # chordal error of a segment of length L on an arc of curvature k is
+    # about k L^2 / 8, so segments should be sqrt(8 tol / k) long: the
+    # wanted samples per unit of t are |r'(t)| sqrt(k / (8 tol)).
+    # that density is measured on a uniform pilot grid and the samples are
+    # placed at equal steps of its integral
+    if curve.sampler is None:
+        curve.sampler = VFunc(curve.curv, curve.df_vector.norm()).compile()
+
+    t = np.linspace(t_range[0], t_range[1], pilot)
+    with np.errstate(all="ignore"):
+        curv, speed = curve.sampler({curve.var_string_symb: t})
+        density = np.nan_to_num(speed * np.sqrt(np.abs(curv) / (8 * tol)))
+
+    cumulative = np.concatenate([[0], np.cumsum((density[1:] + density[:-1]) / 2 * np.diff(t))])
+    n = max(2, int(np.ceil(cumulative[-1])) + 1)
+    t = np.interp(np.linspace(0, cumulative[-1], n), cumulative, t)
+    # a straight curve has no density at all, keep its end points
+    t[0], t[-1] = t_range
+
+    # the estimate assumes slowly varying curvature; near cusps a tight turn
+    # can hide inside one segment, so segments whose midpoint is still
+    # further than tol from their chord are halved
+    paramf = curve.paramf.compile()
+    points = np.column_stack(paramf({curve.var_string_symb: t}))
+    for _ in range(refine):
+        t_mid = (t[1:] + t[:-1]) / 2
+        mid = np.column_stack(paramf({curve.var_string_symb: t_mid}))
+        chord = points[1:] - points[:-1]
+        offset = mid - points[:-1]
+        length = np.maximum(np.sum(chord * chord, axis=1), 1e-300)
+        along = np.clip(np.sum(offset * chord, axis=1) / length, 0, 1)
+        err = np.linalg.norm(offset - along[:, None] * chord, axis=1)
+        bad = np.flatnonzero(err > tol)
+        if not len(bad):
+            break
+        t = np.insert(t, bad + 1, t_mid[bad])
+        points = np.insert(points, bad + 1, mid[bad], axis=0)
+
+    return t, points
+
+class ArcLengthTable:
+
+    # cumulative arc length of a curve at n + 1 equally spaced parameters,
+    # each interval integrated with simpson's rule on |r'|; between the nodes
+    # s(t) is the cubic hermite interpolant of the lengths and speeds, which
+    # is inverted by a few newton steps after a binary search
+
+    def __init__(self, curve, t_range, n=4096):
+        speed = curve.df_vector.norm().compile()
+        self.t = np.linspace(t_range[0], t_range[1], n + 1)
+        nodes_and_mids = speed({curve.var_string_symb: np.concatenate([self.t, (self.t[1:] + self.t[:-1]) / 2])})
+        self.speed = nodes_and_mids[:n + 1]
+        mid_speed = nodes_and_mids[n + 1:]
+
+        self.h = self.t[1] - self.t[0]
+        segments = self.h / 6 * (self.speed[:-1] + 4 * mid_speed + self.speed[1:])
+        self.s = np.concatenate([[0], np.cumsum(segments)])
+        self.length = self.s[-1]
+
+    def hermite(self, i, x):
+        # s and ds/dt on interval i at local coordinate x in [0, 1]
+        h00 = 2 * x ** 3 - 3 * x ** 2 + 1
+        h10 = x ** 3 - 2 * x ** 2 + x
+        h01 = -2 * x ** 3 + 3 * x ** 2
+        h11 = x ** 3 - x ** 2
+        s0, s1 = self.s[i], self.s[i + 1]
+        m0, m1 = self.speed[i] * self.h, self.speed[i + 1] * self.h
+        value = h00 * s0 + h10 * m0 + h01 * s1 + h11 * m1
+        slope = (6 * x ** 2 - 6 * x) * (s0 - s1) + (3 * x ** 2 - 4 * x + 1) * m0 + (3 * x ** 2 - 2 * x) * m1
+        return value, slope / self.h
+
+    def length_at(self, t):
+        # arc length from the start of the table to parameter t
+        t = np.clip(np.asarray(t, dtype=float), self.t[0], self.t[-1])
+        i = np.clip(np.searchsorted(self.t, t, side="right") - 1, 0, len(self.t) - 2)
+        return self.hermite(i, (t - self.t[i]) / self.h)[0]
+
+    def param_at(self, s, steps=3):
+        # parameter at arc length s from the start of the table
+        s = np.clip(np.asarray(s, dtype=float), 0, self.length)
+        i = np.clip(np.searchsorted(self.s, s, side="right") - 1, 0, len(self.t) - 2)
+        ds = self.s[i + 1] - self.s[i]
+        with np.errstate(all="ignore"):
+            x = np.where(ds > 0, (s - self.s[i]) / ds, 0.0)
+            for _ in range(steps):
+                value, slope = self.hermite(i, x)
+                x = np.clip(np.where(slope > 0, x - (value - s) / (slope * self.h), x), 0, 1)
+        return self.t[i] + x * self.h
+
+def arc_length_table(curve, t_range, n):
+    key = (float(t_range[0]), float(t_range[1]), n)
+    if key not in curve.arc_tables:
+        curve.arc_tables[key] = ArcLengthTable(curve, t_range, n)
+    return curve.arc_tables[key]
+
+def cross_2d(a, b):
+    # z component of the cross product of (..., 2) arrays
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def curve_derivatives(curve, t, vectors):
+
+    # all components of the given derivative vectors in one compiled pass,
+    # returned as (len(t), dim) arrays
+    if curve.derivative_kernel is None:
+        curve.derivative_kernel = VFunc(*[f for vec in vectors for f in vec.funcs]).compile()
+    values = curve.derivative_kernel({curve.var_string_symb: np.asarray(t, dtype=float)})
+    dim = curve.paramf.dim
+    return [np.stack(values[i * dim:(i + 1) * dim], axis=-1) for i in range(len(vectors))]
+
 class Curve2D:
 
     def __init__(self, paramf):
@@ -1329,15 +2569,55 @@ class Curve2D:
         # assume first and second variable are in alphabetical order
         self.var_string_symb = list(self.paramf.vars)[0] # only one var
 
-        self.df_vector = paramf.diff(Symb(self.var_string_symb))
-        self.curv_vector = self.df_vector.diff(Symb(self.var_string_symb))
+        self.df_vector = paramf.diff(Symb(self.var_string_symb)).simplify()
+        self.curv_vector = self.df_vector.diff(Symb(self.var_string_symb)).simplify()
         
         df_vect_norm = self.df_vector.norm()
         curv_vect_norm = self.curv_vector.norm()
-        self.curv = Funcs.sqrt(
+        self.curv = simplify(Funcs.sqrt(
             df_vect_norm ** 2 * curv_vect_norm ** 2
             - self.df_vector.innerprod(self.curv_vector) ** 2
-        ) / df_vect_norm ** 3
+        ) / df_vect_norm ** 3)
+
+        self.sampler = None # compiled on first use
+        self.derivative_kernel = None # compiled on first use
+        self.arc_tables = {} # (t_min, t_max, n) -> ArcLengthTable
+
+    def derivatives(self, t):
+        return curve_derivatives(self, t, [self.df_vector, self.curv_vector])
+
+    def curvature(self, t):
+        d1, d2 = self.derivatives(t)
+        with np.errstate(all="ignore"):
+            return np.abs(cross_2d(d1, d2)) / np.linalg.norm(d1, axis=-1) ** 3
+
+    def frenet_frame(self, t):
+        # unit tangent and unit normal (towards the center of curvature) as (n, 2) arrays
+        d1, d2 = self.derivatives(t)
+        with np.errstate(all="ignore"):
+            T = d1 / np.linalg.norm(d1, axis=-1, keepdims=True)
+        # the normal is the tangent turned by 90 degrees towards the bend
+        side = np.where(cross_2d(d1, d2) < 0, -1.0, 1.0)[..., None]
+        return T, side * np.stack([-T[..., 1], T[..., 0]], axis=-1)
+
+    def arc_length_table(self, t_range, n=4096):
+        # built once per range and resolution
+        return arc_length_table(self, t_range, n)
+
+    def arc_length(self, t_range, n=4096):
+        return self.arc_length_table(t_range, n).length
+
+    def sample_by_length(self, t_range, count, n=4096, workers=None, threads=None):
+        # parameters and points spaced equally along the curve
+        table = self.arc_length_table(t_range, n)
+        t = table.param_at(np.linspace(0, table.length, count))
+        return t, evaluate_grid(self.paramf, [(self.var_string_symb, t)], workers, threads)
+
+    def sample(self, t_range, tol=1e-3, pilot=2048, refine=16):
+
+        # parameters (n,) and points (n, dim) with chordal error about tol,
+        # denser where the curvature is high
+        return sample_curve(self, t_range, tol, pilot, refine)
 
     def tangent_line_vect(self, p):
 
@@ -1354,14 +2634,13 @@ class Curve2D:
             CFunc(F_p[1]) + (symb - CFunc(int(p))) * CFunc(dir_vect[1]),
         )
 
-    def show(self, t_range, nt=200, tangent_line_p=None):
+    def show(self, t_range, nt=200, tangent_line_p=None, workers=None, threads=None):
 
         # Parameter grids
         t = np.linspace(t_range[0], t_range[1], nt)
         
         # Vectorized evaluation
-        X = np.vectorize(lambda ti: self.paramf.funcs[0].eval({self.var_string_symb: ti}))(t)
-        Y = np.vectorize(lambda ti: self.paramf.funcs[1].eval({self.var_string_symb: ti}))(t)
+        X, Y = evaluate_grid(self.paramf, [(self.var_string_symb, t)], workers, threads).T
         
         # Plot 3D surface
         fig = plt.figure(figsize=(10, 8))
@@ -1372,8 +2651,7 @@ class Curve2D:
 
             line = self.tangent_line_vect(tangent_line_p)
 
-            X = np.vectorize(lambda ti: line.funcs[0].eval({self.var_string_symb: ti}))(t)
-            Y = np.vectorize(lambda ti: line.funcs[1].eval({self.var_string_symb: ti}))(t)
+            X, Y = line.compile()({self.var_string_symb: t})
 
             ax.plot(X, Y)
 
@@ -1390,21 +2668,74 @@ class Curve3D:
         # assume first and second variable are in alphabetical order
         self.var_string_symb = list(self.paramf.vars)[0] # only one var
 
-        self.df_vector = paramf.diff(Symb(self.var_string_symb))
+        self.df_vector = paramf.diff(Symb(self.var_string_symb)).simplify()
 
-        double_df = self.df_vector.diff(Symb(self.var_string_symb))
-        triple_df = double_df.diff(Symb(self.var_string_symb))
+        double_df = self.df_vector.diff(Symb(self.var_string_symb)).simplify()
+        triple_df = double_df.diff(Symb(self.var_string_symb)).simplify()
+        self.double_df = double_df
+        self.triple_df = triple_df
         t = double_df.cross_prod(self.df_vector).norm()
 
         # from formula found at https://en.wikipedia.org/wiki/Curvature
-        self.curv = t / (self.df_vector.norm() ** 3)
+        self.curv = simplify(t / (self.df_vector.norm() ** 3))
         
-        # determinant
-        self.torsion = (
-            self.df_vector[0] * (double_df.funcs[1] * triple_df.funcs[2] - double_df.funcs[2] * triple_df.funcs[1])
-            - self.df_vector[1] * (double_df.funcs[0] * triple_df.funcs[2] - double_df.funcs[2] * triple_df.funcs[0])
-            + self.df_vector[2] * (double_df.funcs[0] * triple_df.funcs[1] - double_df.funcs[1] * triple_df.funcs[0])
-        ) / (t ** 2)
+        # determinant; a straight line (r' x r'' identically zero) has no
+        # osculating plane, its torsion is left undefined
+        t_squared = simplify(t ** 2)
+        if isinstance(t_squared, CFunc) and t_squared.isnull():
+            self.tors = CFunc(float("nan"))
+        else:
+            self.tors = simplify((
+                self.df_vector.funcs[0] * (double_df.funcs[1] * triple_df.funcs[2] - double_df.funcs[2] * triple_df.funcs[1])
+                - self.df_vector.funcs[1] * (double_df.funcs[0] * triple_df.funcs[2] - double_df.funcs[2] * triple_df.funcs[0])
+                + self.df_vector.funcs[2] * (double_df.funcs[0] * triple_df.funcs[1] - double_df.funcs[1] * triple_df.funcs[0])
+            ) / t_squared)
+
+        self.sampler = None # compiled on first use
+        self.derivative_kernel = None # compiled on first use
+        self.arc_tables = {} # (t_min, t_max, n) -> ArcLengthTable
+
+    def derivatives(self, t):
+        return curve_derivatives(self, t, [self.df_vector, self.double_df, self.triple_df])
+
+    def curvature(self, t):
+        d1, d2, _ = self.derivatives(t)
+        with np.errstate(all="ignore"):
+            return np.linalg.norm(np.cross(d1, d2), axis=-1) / np.linalg.norm(d1, axis=-1) ** 3
+
+    def torsion(self, t):
+        d1, d2, d3 = self.derivatives(t)
+        c = np.cross(d1, d2)
+        with np.errstate(all="ignore"):
+            return np.sum(c * d3, axis=-1) / np.sum(c * c, axis=-1)
+
+    def frenet_frame(self, t):
+        # tangent, normal and binormal as (n, 3) arrays
+        d1, d2, _ = self.derivatives(t)
+        c = np.cross(d1, d2)
+        with np.errstate(all="ignore"):
+            T = d1 / np.linalg.norm(d1, axis=-1, keepdims=True)
+            B = c / np.linalg.norm(c, axis=-1, keepdims=True)
+        return T, np.cross(B, T), B
+
+    def arc_length_table(self, t_range, n=4096):
+        # built once per range and resolution
+        return arc_length_table(self, t_range, n)
+
+    def arc_length(self, t_range, n=4096):
+        return self.arc_length_table(t_range, n).length
+
+    def sample_by_length(self, t_range, count, n=4096, workers=None, threads=None):
+        # parameters and points spaced equally along the curve
+        table = self.arc_length_table(t_range, n)
+        t = table.param_at(np.linspace(0, table.length, count))
+        return t, evaluate_grid(self.paramf, [(self.var_string_symb, t)], workers, threads)
+
+    def sample(self, t_range, tol=1e-3, pilot=2048, refine=16):
+
+        # parameters (n,) and points (n, dim) with chordal error about tol,
+        # denser where the curvature is high
+        return sample_curve(self, t_range, tol, pilot, refine)
 
     def tangent_line_vect(self, p):
 
@@ -1422,15 +2753,13 @@ class Curve3D:
             CFunc(F_p[2]) + (symb - CFunc(int(p))) * CFunc(dir_vect[2])
         )
     
-    def show(self, t_range, nt=200, tangent_line_p=None):
+    def show(self, t_range, nt=200, tangent_line_p=None, workers=None, threads=None):
 
         # Parameter grids
         t = np.linspace(t_range[0], t_range[1], nt)
         
         # Vectorized evaluation
-        X = np.vectorize(lambda ti: self.paramf.funcs[0].eval({self.var_string_symb: ti}))(t)
-        Y = np.vectorize(lambda ti: self.paramf.funcs[1].eval({self.var_string_symb: ti}))(t)
-        Z = np.vectorize(lambda ti: self.paramf.funcs[2].eval({self.var_string_symb: ti}))(t)
+        X, Y, Z = evaluate_grid(self.paramf, [(self.var_string_symb, t)], workers, threads).T
         
         # Plot 3D surface
         fig = plt.figure(figsize=(10, 8))
@@ -1441,10 +2770,452 @@ class Curve3D:
 
             line = self.tangent_line_vect(tangent_line_p)
 
-            X = np.vectorize(lambda ti: line.funcs[0].eval({self.var_string_symb: ti}))(t)
-            Y = np.vectorize(lambda ti: line.funcs[1].eval({self.var_string_symb: ti}))(t)
-            Z = np.vectorize(lambda ti: line.funcs[2].eval({self.var_string_symb: ti}))(t)
+            X, Y, Z = line.compile()({self.var_string_symb: t})
 
             ax.plot(X, Y, Z)
 
         plt.show()
+
+def prune_blocks(func, level, vars_list, lows, cell, block, nb):
+
+    # a 2^d-tree over a grid of nb blocks per axis (each block holds block
+    # cells of size cell): boxes whose interval enclosure of func excludes
+    # level are discarded, the rest are halved until single blocks remain.
+    # returns the lower block indices of those remaining blocks
+    dims = len(vars_list)
+    interval = IntervalKernel([func])
+
+    # boxes are index ranges [lo, hi) in units of blocks
+    box_lo = np.zeros((1, dims), dtype=np.int64)
+    box_hi = np.full((1, dims), nb, dtype=np.int64)
+    leaves = []
+    while len(box_lo):
+        f_lo, f_hi = interval({
+            var: (lows[i] + box_lo[:, i] * block * cell[i], lows[i] + box_hi[:, i] * block * cell[i])
+            for i, var in enumerate(vars_list)
+        })[0]
+        # a little slack for rounding in the enclosures
+        slack = 1e-9 * (np.abs(f_lo) + np.abs(f_hi) + 1)
+        keep = (f_lo <= level + slack) & (f_hi >= level - slack)
+        box_lo, box_hi = box_lo[keep], box_hi[keep]
+
+        is_leaf = np.all(box_hi - box_lo == 1, axis=1)
+        leaves.append(box_lo[is_leaf])
+        box_lo, box_hi = box_lo[~is_leaf], box_hi[~is_leaf]
+
+        # split every remaining box in two along each axis that is still wider than a block
+        mid = (box_lo + box_hi) // 2
+        for axis in range(dims):
+            wide = box_hi[:, axis] - box_lo[:, axis] > 1
+            upper_lo = box_lo[wide].copy()
+            upper_lo[:, axis] = mid[wide, axis]
+            lower_hi = box_hi.copy()
+            lower_hi[wide, axis] = mid[wide, axis]
+            box_lo = np.concatenate([box_lo, upper_lo])
+            box_hi = np.concatenate([lower_hi, box_hi[wide]])
+            mid = np.concatenate([mid, mid[wide]])
+
+    return np.concatenate(leaves)
+
+def join_meshes(parts):
+
+    # parts are (verts, faces, normals) with faces indexing their own verts
+    if not parts:
+        return (
+            np.empty((0, 3), dtype=np.float32),
+            np.empty((0, 3), dtype=np.int32),
+            np.empty((0, 3), dtype=np.float32)
+        )
+    offsets = np.cumsum([0] + [len(verts) for verts, _, _ in parts[:-1]])
+    return (
+        np.concatenate([verts for verts, _, _ in parts]).astype(np.float32),
+        np.concatenate([faces + off for (_, faces, _), off in zip(parts, offsets)]).astype(np.int32),
+        np.concatenate([normals for _, _, normals in parts]).astype(np.float32)
+    )
+
+def weld_meshes(parts, lows, cell):
+
+    # parts are (verts, faces, normals) with verts in lattice units, from
+    # pieces of one sample lattice triangulated apart (slabs, blocks). a
+    # vertex on a face two pieces share is interpolated from the same two
+    # samples in both, so it comes out bit for bit the same and merging
+    # equal vertices closes the seams; their normals are averaged.
+    # returns world coordinates, vertices and faces in lexicographic order
+    if not parts:
+        return join_meshes(parts)
+    offsets = np.cumsum([0] + [len(verts) for verts, _, _ in parts[:-1]])
+    verts = np.concatenate([verts for verts, _, _ in parts])
+    faces = np.concatenate([faces + off for (_, faces, _), off in zip(parts, offsets)])
+    normals = np.concatenate([normals for _, _, normals in parts])
+
+    order = np.lexsort(verts.T[::-1])
+    verts = verts[order]
+    new = np.concatenate([[True], np.any(verts[1:] != verts[:-1], axis=1)])
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(new) - 1
+    verts = verts[new]
+    summed = np.stack([np.bincount(inverse, normals[:, i], len(verts)) for i in range(3)], axis=1)
+    norms = np.linalg.norm(summed, axis=1, keepdims=True)
+    normals = np.divide(summed, norms, out=np.zeros_like(summed), where=norms > 0)
+
+    # faces start at their smallest vertex and are sorted, so the result does
+    # not depend on how the lattice was cut up
+    faces = inverse[faces]
+    first = np.argmin(faces, axis=1)[:, None]
+    faces = np.take_along_axis(faces, (first + np.arange(3)) % 3, axis=1)
+    faces = faces[np.lexsort(faces.T[::-1])]
+
+    return (
+        (lows + verts * cell).astype(np.float32),
+        faces.astype(np.int32),
+        normals.astype(np.float32)
+    )
+
+class ImplicitSurface:
+
+    def __init__(self, func, level=0, vars=("x", "y", "z")):
+
+        # surface func(x, y, z) = level
+        func = to_node(func)
+        assert func.vars <= set(vars), AssertionError(f"unknown variables in {func}")
+        self.func = func
+        self.level = level
+        self.vars_list = list(vars)
+
+    def mesh(self, x_range, y_range, z_range, n=128, max_bytes=64 * 2**20, workers=None, threads=None):
+
+        # n is the amount of samples per axis (int or triple)
+        # the volume is evaluated and triangulated in slabs along z of at most
+        # max_bytes of float64 samples, so it is never held in memory at once;
+        # the slabs are welded along the planes they share, so the mesh does
+        # not depend on max_bytes.
+        # with workers or threads every slab is evaluated by that many processes or threads
+        nx, ny, nz = (n, n, n) if isinstance(n, int) else n
+        x = np.linspace(x_range[0], x_range[1], nx)
+        y = np.linspace(y_range[0], y_range[1], ny)
+        z = np.linspace(z_range[0], z_range[1], nz)
+        lows = np.array([x[0], y[0], z[0]])
+        spacing = np.array([x[1] - x[0], y[1] - y[0], z[1] - z[0]])
+
+        serial = workers is None and threads is None
+        if serial:
+            kernel = self.func.compile()
+        else:
+            pool = grid_pool([self.func], workers, threads)
+        depth = max(2, max_bytes // (nx * ny * 8))
+
+        parts = []
+        plane = None
+        try:
+            for k0 in range(0, nz - 1, depth - 1):
+                k1 = min(k0 + depth, nz)
+
+                # slabs share their boundary plane so no cells are lost; it is
+                # carried over rather than evaluated again, so both slabs see
+                # the same samples there
+                start = k0 if plane is None else k0 + 1
+                if serial:
+                    volume = kernel({
+                        self.vars_list[0]: x[:, None, None],
+                        self.vars_list[1]: y[None, :, None],
+                        self.vars_list[2]: z[None, None, start:k1]
+                    })
+                else:
+                    volume = pool([(self.vars_list[0], x), (self.vars_list[1], y), (self.vars_list[2], z[start:k1])])[..., 0]
+                volume = np.broadcast_to(volume, (nx, ny, k1 - start))
+                if plane is not None:
+                    volume = np.concatenate([plane, volume], axis=2)
+                plane = volume[:, :, -1:]
+                part = self.triangulate(volume, (0, 0, k0))
+                if part is not None:
+                    parts.append(part)
+        finally:
+            if not serial:
+                pool.close()
+
+        return weld_meshes(parts, lows, spacing)
+
+    def triangulate(self, volume, corner):
+
+        # vertices in lattice units, corner is the lattice index of volume[0, 0, 0]
+        volume = volume.astype(np.float32)
+        # blocks the surface does not cross are skipped
+        if not np.nanmin(volume) <= self.level <= np.nanmax(volume):
+            return None
+
+        # marching_cubes only scales the vertices by the spacing, so they are
+        # taken unscaled, exact in lattice units
+        verts, faces, normals, _ = measure.marching_cubes(volume, level=self.level)
+        return verts.astype(float) + corner, faces, normals
+
+    def mesh_adaptive(self, x_range, y_range, z_range, n=512, block=16, batch=256):
+
+        # same resolution as mesh(..., n + 1) but only blocks of block^3 cells
+        # near the surface are sampled: an octree over the domain discards
+        # every box whose interval enclosure of func excludes the level
+        assert n % block == 0, AssertionError("n must be a multiple of block")
+        lows = np.array([x_range[0], y_range[0], z_range[0]], dtype=float)
+        cell = (np.array([x_range[1], y_range[1], z_range[1]], dtype=float) - lows) / n
+        leaves = prune_blocks(self.func, self.level, self.vars_list, lows, cell, block, n // block)
+
+        # sample the surviving blocks, a batch at a time. samples are placed
+        # from their integer lattice index, so blocks sharing a face see the
+        # same values on it and their meshes weld along it
+        kernel = self.func.compile()
+        offsets = np.arange(block + 1)
+        parts = []
+        for b0 in range(0, len(leaves), batch):
+            corners = leaves[b0:b0 + batch] * block
+            volumes = kernel({
+                self.vars_list[0]: lows[0] + (corners[:, 0, None, None, None] + offsets[None, :, None, None]) * cell[0],
+                self.vars_list[1]: lows[1] + (corners[:, 1, None, None, None] + offsets[None, None, :, None]) * cell[1],
+                self.vars_list[2]: lows[2] + (corners[:, 2, None, None, None] + offsets[None, None, None, :]) * cell[2]
+            })
+            for corner, volume in zip(corners, volumes):
+                part = self.triangulate(volume, corner)
+                if part is not None:
+                    parts.append(part)
+
+        return weld_meshes(parts, lows, cell)
+
+    def show(self, x_range, y_range, z_range, n=64, workers=None, threads=None):
+
+        verts, faces, _ = self.mesh(x_range, y_range, z_range, n, workers=workers, threads=threads)
+
+        fig = plt.figure(figsize=(10, 8))
+        ax = fig.add_subplot(111, projection='3d')
+        ax.add_collection3d(Poly3DCollection(verts[faces], alpha=0.8))
+
+        ax.set_xlim(*x_range)
+        ax.set_ylim(*y_range)
+        ax.set_zlim(*z_range)
+
+        plt.show()
+
+def join_polylines(pieces):
+
+    # pieces are (M, 2) polylines in lattice units, cut where blocks meet;
+    # the cut points come out bit for bit the same on both sides and all
+    # pieces run the same way round, so each end continues as the piece
+    # starting there. returns the joined polylines, closed ones ending on
+    # their first point
+    # where the curve runs through a sample point on a border (a crossing),
+    # several pieces can start at one point, any of them continues it
+    starts = {}
+    for i, piece in enumerate(pieces):
+        if not np.array_equal(piece[0], piece[-1]):
+            starts.setdefault(tuple(piece[0]), []).append(i)
+    ends = {tuple(piece[-1]) for piece in pieces if not np.array_equal(piece[0], piece[-1])}
+
+    used = set()
+
+    def follow(i):
+        chain = [pieces[i]]
+        used.add(i)
+        while True:
+            following = [j for j in starts.get(tuple(chain[-1][-1]), []) if j not in used]
+            if not following:
+                return np.concatenate([chain[0]] + [piece[1:] for piece in chain[1:]])
+            chain.append(pieces[following[0]])
+            used.add(following[0])
+
+    lines = []
+    # open curves first, from the pieces nothing leads into
+    for i, piece in enumerate(pieces):
+        if i not in used and not np.array_equal(piece[0], piece[-1]) and tuple(piece[0]) not in ends:
+            lines.append(follow(i))
+    # what is left are closed curves, started anywhere
+    for i in range(len(pieces)):
+        if i not in used:
+            lines.append(follow(i))
+    return lines
+
+class ImplicitCurve2D:
+
+    def __init__(self, func, level=0, vars=("x", "y")):
+
+        # curve func(x, y) = level
+        func = to_node(func)
+        assert func.vars <= set(vars), AssertionError(f"unknown variables in {func}")
+        self.func = func
+        self.level = level
+        self.vars_list = list(vars)
+
+    def contours(self, x_range, y_range, n=1024, block=16, batch=1024):
+
+        # n cells per axis; a quadtree discards every box whose interval
+        # enclosure of func excludes the level, so only blocks of block^2
+        # cells around the curve are sampled and contoured.
+        # returns a list of (M, 2) arrays of points, one per connected curve
+        # as a single find_contours over the whole grid would give it; closed
+        # curves end on their first point
+        assert n % block == 0, AssertionError("n must be a multiple of block")
+        lows = np.array([x_range[0], y_range[0]], dtype=float)
+        cell = (np.array([x_range[1], y_range[1]], dtype=float) - lows) / n
+        leaves = prune_blocks(self.func, self.level, self.vars_list, lows, cell, block, n // block)
+
+        # samples are placed from their integer lattice index, so blocks
+        # sharing a border see the same values on it
+        kernel = self.func.compile()
+        offsets = np.arange(block + 1)
+        pieces = []
+        for b0 in range(0, len(leaves), batch):
+            corners = leaves[b0:b0 + batch] * block
+            grids = kernel({
+                self.vars_list[0]: lows[0] + (corners[:, 0, None, None] + offsets[None, :, None]) * cell[0],
+                self.vars_list[1]: lows[1] + (corners[:, 1, None, None] + offsets[None, None, :]) * cell[1]
+            })
+            for corner, grid in zip(corners, grids):
+                # blocks without a sign change hold no piece of the curve
+                if not np.nanmin(grid) <= self.level <= np.nanmax(grid):
+                    continue
+                for piece in measure.find_contours(grid, self.level):
+                    pieces.append(piece + corner)
+
+        return [lows + line * cell for line in join_polylines(pieces)]
+
+    def show(self, x_range, y_range, n=512):
+
+        pieces = self.contours(x_range, y_range, n)
+
+        fig = plt.figure(figsize=(10, 8))
+        ax = fig.add_subplot()
+        for piece in pieces:
+            ax.plot(piece[:, 0], piece[:, 1], color="C0")
+
+        ax.set_xlim(*x_range)
+        ax.set_ylim(*y_range)
+        ax.set_aspect("equal")
+
+        plt.show()
+
+class PlyWriter:
+
+    # binary little endian PLY, vertex and face blocks are memory mapped
+    vertex_dtype = np.dtype([
+        ("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+        ("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")
+    ])
+    face_dtype = np.dtype([("n", "u1"), ("v", "<i4", (3,))])
+
+    def __init__(self, path, n_verts, n_faces):
+        header = (
+            "ply\nformat binary_little_endian 1.0\n"
+            f"element vertex {n_verts}\n"
+            "property float x\nproperty float y\nproperty float z\n"
+            "property float nx\nproperty float ny\nproperty float nz\n"
+            f"element face {n_faces}\n"
+            "property list uchar int vertex_indices\n"
+            "end_header\n"
+        ).encode("ascii")
+        vert_bytes = n_verts * self.vertex_dtype.itemsize
+        face_bytes = n_faces * self.face_dtype.itemsize
+        with open(path, "wb") as f:
+            f.write(header)
+            f.truncate(len(header) + vert_bytes + face_bytes)
+
+        self.verts = self.faces = None
+        if n_verts:
+            self.verts = np.memmap(path, dtype=self.vertex_dtype, mode="r+", offset=len(header), shape=(n_verts,))
+        if n_faces:
+            self.faces = np.memmap(path, dtype=self.face_dtype, mode="r+", offset=len(header) + vert_bytes, shape=(n_faces,))
+
+    def write(self, vert_start, verts, normals, n_owned, face_start, faces):
+        # faces index into verts, which start at global index vert_start
+        if n_owned:
+            block = self.verts[vert_start:vert_start + n_owned]
+            for i, name in enumerate(("x", "y", "z")):
+                block[name] = verts[:n_owned, i]
+            for i, name in enumerate(("nx", "ny", "nz")):
+                block[name] = normals[:n_owned, i] if normals is not None else 0
+        if len(faces):
+            block = self.faces[face_start:face_start + len(faces)]
+            block["n"] = 3
+            block["v"] = faces + vert_start
+
+    def close(self):
+        for mm in (self.verts, self.faces):
+            if mm is not None:
+                mm.flush()
+        self.verts = self.faces = None
+
+class StlWriter:
+
+    # binary STL, one memory mapped 50 byte record per triangle
+    record_dtype = np.dtype([("normal", "<f4", (3,)), ("v", "<f4", (3, 3)), ("attr", "<u2")])
+
+    def __init__(self, path, n_verts, n_faces):
+        with open(path, "wb") as f:
+            f.write(b"binary STL".ljust(80, b" "))
+            f.write(np.uint32(n_faces).tobytes())
+            f.truncate(84 + n_faces * self.record_dtype.itemsize)
+        self.records = None
+        if n_faces:
+            self.records = np.memmap(path, dtype=self.record_dtype, mode="r+", offset=84, shape=(n_faces,))
+
+    def write(self, vert_start, verts, normals, n_owned, face_start, faces):
+        if not len(faces):
+            return
+        tri = verts[faces]
+        facet = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        norms = np.linalg.norm(facet, axis=1, keepdims=True)
+        facet = np.divide(facet, norms, out=np.zeros_like(facet), where=norms > 0)
+
+        block = self.records[face_start:face_start + len(faces)]
+        block["normal"] = facet
+        block["v"] = tri
+        block["attr"] = 0
+
+    def close(self):
+        if self.records is not None:
+            self.records.flush()
+        self.records = None
+
+class ObjWriter:
+
+    # wavefront OBJ is text, so tiles are appended to the file instead;
+    # faces are held back until the vertices they use have been written
+    def __init__(self, path, n_verts, n_faces):
+        self.file = open(path, "w")
+        self.pending = None
+
+    def write(self, vert_start, verts, normals, n_owned, face_start, faces):
+        if n_owned:
+            np.savetxt(self.file, verts[:n_owned], fmt="v %.7g %.7g %.7g")
+            if normals is not None:
+                np.savetxt(self.file, normals[:n_owned], fmt="vn %.7g %.7g %.7g")
+        self.flush_faces()
+        if len(faces):
+            self.pending = (faces + vert_start + 1, normals is not None)
+
+    def flush_faces(self):
+        if self.pending is None:
+            return
+        faces, has_normals = self.pending
+        if has_normals:
+            np.savetxt(self.file, np.repeat(faces, 2, axis=1), fmt="f %d//%d %d//%d %d//%d")
+        else:
+            np.savetxt(self.file, faces, fmt="f %d %d %d")
+        self.pending = None
+
+    def close(self):
+        self.flush_faces()
+        self.file.close()
+
+MESH_WRITERS = {".ply": PlyWriter, ".stl": StlWriter, ".obj": ObjWriter}
+
+def mesh_writer(path, n_verts, n_faces):
+    ext = os.path.splitext(path)[1].lower()
+    assert ext in MESH_WRITERS, AssertionError(f"unsupported mesh format {ext}")
+    return MESH_WRITERS[ext](path, n_verts, n_faces)
+
+def export_mesh(path, verts, faces, normals=None, chunk=1 << 20):
+
+    # writes an already tessellated, indexed mesh (e.g. from
+    # ImplicitSurface.mesh or mesh_adaptive, both welded into one closed
+    # surface), chunk faces at a time
+    writer = mesh_writer(path, len(verts), len(faces))
+    writer.write(0, verts, normals, len(verts), 0, faces[:0])
+    for f0 in range(0, len(faces), chunk):
+        writer.write(0, verts, normals, 0, f0, faces[f0:f0 + chunk])
+    writer.close()
@@ -14,4 +14,214 @@ print(df.eval({"x": 1, "y": 1}))
 v = VFunc(f, g)
 print(v)
 norm = v.norm()
-print(norm)
\ No newline at end of file
+print(norm)
+
+# simplified expressions keep their values
+import numpy as np
+from main import CFunc, Surface, simplify
+
+P = {"x": np.linspace(-2, 2, 7), "y": np.linspace(0.3, 1.7, 7)}
+exprs = [
+    Funcs.sin(x) ** 2 * Funcs.cos(x) + Funcs.cos(x) ** 2,
+    Funcs.sin(x) ** 2 + Funcs.cos(x) ** 2 * y,
+    y * Funcs.cos(x) ** 2 + y * Funcs.sin(x) ** 2 * Funcs.cos(x),
+    Funcs.sin(x) ** 4 * Funcs.cos(x) ** 3 + Funcs.sin(x) ** 2 * Funcs.cos(x) ** 5,
+    (x + y) ** 2 - x * (x + 2 * y) - y ** 2 * Funcs.sin(x) ** 2,
+]
+
+# random sums of products of sin, cos and powers, where the rewrites apply
+rng = np.random.default_rng(0)
+atoms = [x, y, Funcs.sin(x), Funcs.cos(x), Funcs.sin(y), Funcs.cos(y)]
+for _ in range(200):
+    e = CFunc(0)
+    for _ in range(rng.integers(1, 4)):
+        term = CFunc(int(rng.integers(-3, 4)))
+        for _ in range(rng.integers(1, 4)):
+            term = term * atoms[rng.integers(len(atoms))] ** int(rng.integers(1, 4))
+        e = e + term
+    exprs.append(e)
+
+for e in exprs:
+    assert np.allclose(simplify(e).eval(P), e.eval(P)), AssertionError(f"{e} simplified to {simplify(e)}")
+
+u = Symb("u")
+v = Symb("v")
+surface = Surface(VFunc(u * Funcs.cos(v) ** 2 + u * Funcs.sin(v) ** 2 * Funcs.cos(v), v, u))
+positions, df_1, df_2, _ = surface.tangent_planes([(0.5, 1.0)])
+assert np.allclose(df_1[0], [f.eval({"u": 0.5, "v": 1.0}) for f in surface.df_1.funcs]), AssertionError()
+print("simplify ok")
+
+
+# implicit meshes do not depend on how the volume is cut up
+from main import ImplicitSurface
+
+def open_edges(faces):
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return int((counts != 2).sum())
+
+z = Symb("z")
+sphere = ImplicitSurface(x ** 2 + y ** 2 + z ** 2 - 1)
+box = (-1.5, 1.5)
+whole = sphere.mesh(box, box, box, n=65)
+slabs = sphere.mesh(box, box, box, n=65, max_bytes=65 * 65 * 8 * 9)
+assert open_edges(whole[1]) == 0 and open_edges(slabs[1]) == 0, AssertionError()
+assert np.array_equal(whole[1], slabs[1]) and np.allclose(whole[0], slabs[0], atol=1e-6), AssertionError()
+blocks = sphere.mesh_adaptive(box, box, box, n=64, block=8)
+assert open_edges(blocks[1]) == 0, AssertionError()
+assert np.array_equal(whole[1], blocks[1]) and np.allclose(whole[0], blocks[0], atol=1e-6), AssertionError()
+print("implicit mesh ok")
+
+
+# meshes survive a round trip through the file formats
+import os
+import tempfile
+from main import export_mesh
+
+def read_ply(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    end = data.index(b"end_header\n") + len(b"end_header\n")
+    header = data[:end].decode("ascii").split()
+    n_verts = int(header[header.index("vertex") + 1])
+    n_faces = int(header[header.index("face") + 1])
+    verts = np.frombuffer(data, dtype="<f4", count=6 * n_verts, offset=end).reshape(-1, 6)
+    faces = np.frombuffer(data, dtype=np.dtype([("n", "u1"), ("v", "<i4", (3,))]), count=n_faces, offset=end + 24 * n_verts)
+    assert np.all(faces["n"] == 3), AssertionError()
+    return verts[:, :3], faces["v"], verts[:, 3:]
+
+folder = tempfile.mkdtemp()
+path = os.path.join(folder, "sphere.ply")
+export_mesh(path, *whole)
+verts, faces, normals = read_ply(path)
+assert np.array_equal(verts, whole[0]) and np.array_equal(faces, whole[1]) and np.array_equal(normals, whole[2]), AssertionError()
+assert open_edges(faces) == 0 and len(np.unique(verts, axis=0)) == len(verts), AssertionError()
+print("export ok")
+
+def read_stl(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    n_faces = int(np.frombuffer(data, dtype="<u4", count=1, offset=80)[0])
+    records = np.frombuffer(data, dtype=np.dtype([("normal", "<f4", (3,)), ("v", "<f4", (3, 3)), ("attr", "<u2")]), count=n_faces, offset=84)
+    return records["v"]
+
+def read_obj(path):
+    verts, normals, faces = [], [], []
+    with open(path) as file:
+        for line in file:
+            kind, *fields = line.split()
+            if kind == "v":
+                verts.append([float(f) for f in fields])
+            elif kind == "vn":
+                normals.append([float(f) for f in fields])
+            elif kind == "f":
+                faces.append([int(f.split("/")[0]) - 1 for f in fields])
+    return np.array(verts), np.array(faces), np.array(normals)
+
+torus = Surface(VFunc((2 + Funcs.cos(v)) * Funcs.cos(u), (2 + Funcs.cos(v)) * Funcs.sin(u), Funcs.sin(v)))
+grid = ((0, 6), (0, 6), 17, 23)
+expected = torus.mesh(*grid)
+for ext in (".ply", ".stl", ".obj"):
+    path = os.path.join(folder, "torus" + ext)
+    # 5 does not divide the 22 rows of cells
+    torus.export(path, *grid, tile_rows=5)
+    if ext == ".ply":
+        got = read_ply(path)
+        assert all(np.array_equal(a, b) for a, b in zip(got, expected)), AssertionError(ext)
+    elif ext == ".stl":
+        assert np.array_equal(read_stl(path), expected[0][expected[1]]), AssertionError(ext)
+    else:
+        verts, faces, normals = read_obj(path)
+        assert np.array_equal(faces, expected[1]), AssertionError(ext)
+        assert np.allclose(verts, expected[0], rtol=1e-6, atol=1e-6) and np.allclose(normals, expected[2], rtol=1e-6, atol=1e-6), AssertionError(ext)
+print("surface export ok")
+
+
+# blocked contours join up like a single find_contours over the grid
+from skimage import measure
+from main import ImplicitCurve2D
+
+for f in (x ** 2 + y ** 2 - 1, Funcs.sin(3 * x) * Funcs.cos(2 * y) - 0.2):
+    lines = ImplicitCurve2D(f).contours((-2, 2), (-2, 2), n=256, block=16)
+    g = np.linspace(-2, 2, 257)
+    whole = measure.find_contours(f.compile()({"x": g[:, None], "y": g[None, :]}), 0)
+    assert sorted(len(l) for l in lines) == sorted(len(l) for l in whole), AssertionError(f"{len(lines)} contours of {f}")
+    # closed curves may start at another point, so compare the point sets
+    got = np.unique(np.concatenate(lines).round(9), axis=0)
+    ref = np.unique((np.concatenate(whole) * (g[1] - g[0]) - 2).round(9), axis=0)
+    assert got.shape == ref.shape and np.allclose(got, ref, atol=1e-8), AssertionError()
+print("contours ok")
+
+
+# forward and reverse mode of the tape agree with the symbolic derivatives
+rng = np.random.default_rng(1)
+
+def random_expr(depth):
+    if depth == 0:
+        return [x, y, z, CFunc(float(rng.integers(1, 4)))][rng.integers(4)]
+    a = random_expr(depth - 1)
+    b = random_expr(depth - 1)
+    return [
+        a + b, a - b, a * b,
+        a / (2 + Funcs.cos(b)),
+        Funcs.sin(a), Funcs.cos(a) * b,
+        Funcs.sqrt(1 + a ** 2), Funcs.ln(2 + Funcs.sin(a)),
+        a ** int(rng.integers(2, 4)), (1 + b ** 2) ** 1.5,
+        -a
+    ][rng.integers(11)]
+
+P = {name: rng.uniform(-1.5, 1.5, 50) for name in ("x", "y", "z")}
+for _ in range(20):
+    func = VFunc(*[random_expr(int(rng.integers(1, 5))) for _ in range(3)])
+    wrt = ["x", "y", "z"]
+    value, forward = func.value_and_jacobian(P, wrt, "forward")
+    _, reverse = func.value_and_jacobian(P, wrt, "reverse")
+    symbolic = np.array([func.diff(Symb(w)).compile()(P) for w in wrt]).transpose(1, 0, 2)
+    assert np.allclose(value, func.compile()(P)), AssertionError(str(func))
+    assert np.allclose(forward, reverse) and np.allclose(forward, symbolic), AssertionError(str(func))
+print("tape ok")
+
+
+# interval enclosures contain every sampled value of the function on the box
+from main import IntervalKernel
+
+rng = np.random.default_rng(2)
+violations = 0
+for _ in range(200):
+    func = random_expr(int(rng.integers(1, 5)))
+    lows = {name: rng.uniform(-3, 3) for name in ("x", "y", "z")}
+    highs = {name: lows[name] + rng.uniform(0, 2) for name in ("x", "y", "z")}
+    lo, hi = IntervalKernel([func])({name: (lows[name], highs[name]) for name in lows})[0]
+    samples = {name: rng.uniform(lows[name], highs[name], 100) for name in lows}
+    samples = {name: np.append(s, [lows[name], highs[name]]) for name, s in samples.items()}
+    with np.errstate(all="ignore"):
+        vals = np.broadcast_to(VFunc(func).compile()(samples)[0], (102,))
+    slack = 1e-9 * (1 + np.abs(vals))
+    bad = np.isfinite(vals) & ((vals < lo - slack) | (vals > hi + slack))
+    violations += int(bad.any())
+assert violations == 0, AssertionError(f"{violations} unsound boxes")
+print("interval ok")
+
+
+# long chains built in a loop compile without hitting the recursion limit
+chain = 0
+for i in range(3000):
+    chain = chain + Funcs.sin(x * (i + 1))
+X = np.linspace(0, 1, 5)
+ref = sum(np.sin(X * (i + 1)) for i in range(3000))
+assert np.allclose(VFunc(chain).compile()({"x": X})[0], ref), AssertionError()
+print("schedule ok")
+
+
+# grid pools fill a given output array in place, like a new one
+from main import GridPool, ThreadGrid
+
+if __name__ == "__main__":
+    grid = VFunc(Funcs.sin(x) * y, x + y ** 2)
+    axes = [(x, np.linspace(0, 1, 7)), (y, np.linspace(-1, 1, 5))]
+    for pool in (GridPool(grid.funcs, 2), ThreadGrid(grid.funcs, 2)):
+        with pool:
+            new = pool(axes)
+            out = np.zeros((7, 5, 2))
+            assert pool(axes, out=out) is out and np.array_equal(out, new), AssertionError()
+    print("grid out ok")